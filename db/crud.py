@@ -111,3 +111,33 @@ def create_utterance_stt(db: Session, utterance_stt: schemas.UtteranceSTTCreate)
 
 def get_utterances_stt(db: Session) -> list[models.UtteranceSTT]:
     return db.query(models.UtteranceSTT).all()
+
+
+def create_synthesis_job(db: Session, job: schemas.SynthesisJobCreate, translation_id: int) -> models.SynthesisJob:
+    db_job = models.SynthesisJob(**job.dict(), translation_id=translation_id)
+    db.add(db_job)
+    db.commit()
+    db.refresh(db_job)
+    return db_job
+
+
+def get_synthesis_job(db: Session, job_id: int) -> models.SynthesisJob:
+    return db.query(models.SynthesisJob).filter(models.SynthesisJob.id == job_id).first()
+
+
+def get_next_synthesis_job(db: Session, min_priority: int = None) -> models.SynthesisJob:
+    query = db.query(models.SynthesisJob).filter(models.SynthesisJob.status == 'queued')
+    if min_priority is not None:
+        query = query.filter(models.SynthesisJob.priority >= min_priority)
+    return query.order_by(models.SynthesisJob.priority.desc(), models.SynthesisJob.id).first()
+
+
+def get_synthesis_jobs_by_status(db: Session, status: str) -> list[models.SynthesisJob]:
+    return db.query(models.SynthesisJob).filter(models.SynthesisJob.status == status).all()
+
+
+def get_active_synthesis_job(db: Session, translation_id: int, kind: str) -> models.SynthesisJob:
+    return db.query(models.SynthesisJob).filter(
+        and_(models.SynthesisJob.translation_id == translation_id,
+             models.SynthesisJob.kind == kind,
+             models.SynthesisJob.status.in_(['queued', 'running']))).first()
@@ -2,7 +2,7 @@ import pathlib
 from sqlalchemy import Column, Integer, String, ForeignKey, Text, DateTime, Float, UniqueConstraint
 from sqlalchemy.orm import relationship
 
-from config import data_root
+from config import cfg, data_root
 from db.database import Base
 
 
@@ -50,7 +50,13 @@ class CrossProject(Base):
 
     def get_vocals_wav_path(self) -> pathlib.Path:
         vocals_name = f"{self.get_media_path().stem}.vocals.wav"
-        return self.get_media_path().parent.joinpath(f"htdemucs/{vocals_name}")
+        return self.get_media_path().parent.joinpath(cfg.demucs.model_name, vocals_name)
+
+    def get_diarization_path(self) -> pathlib.Path:
+        return self.get_data_root().joinpath("diarization.rttm")
+
+    def get_transcription_checkpoint_path(self) -> pathlib.Path:
+        return self.get_data_root().joinpath("transcription.checkpoint.jsonl")
 
 
 
@@ -76,7 +82,9 @@ class Translation(Base):
     date_completed = Column(DateTime)
     cross_project_id = Column(Integer, ForeignKey("crosslingual_project.id"))
     cross_project = relationship("CrossProject", back_populates="translations", lazy="joined")
-    utterances = relationship("Utterance", back_populates="translation", cascade="all,delete-orphan")
+    # utterances can be synthesized out of order, they are always read in order of the text.
+    utterances = relationship("Utterance", back_populates="translation", cascade="all,delete-orphan",
+                              order_by="Utterance.utterance_idx")
 
     def get_data_root(self):
         root: pathlib.Path = self.cross_project.get_data_root().joinpath(f"translation_{self.id}")
@@ -104,6 +112,10 @@ class Speaker(Base):
         speaker_dir_path.mkdir(parents=True, exist_ok=True)
         return speaker_dir_path
 
+    def get_latents_path(self) -> pathlib.Path:
+        # kept outside of speaker data root, which tortoise treats as a set of voice samples.
+        return self.get_speaker_data_root().parent.joinpath(f"{self.name.lower()}.latents.pth")
+
 
 class Utterance(Base):
     __tablename__ = "utterance"
@@ -132,3 +144,23 @@ class UtteranceSTT(Base):
     date = Column(DateTime, nullable=False)
     levenstein_similarity = Column(Float)
     orig_utterance_id = Column(Integer, ForeignKey("utterance.id"))
+
+
+class SynthesisJob(Base):
+    __tablename__ = "synthesis_job"
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)  # read | reread | playground
+    priority = Column(Integer, nullable=False, default=0)  # higher runs first
+    status = Column(String, nullable=False)  # queued | running | completed | failed | cancelled
+    params = Column(Text, nullable=False)  # json encoded job arguments
+    num_total = Column(Integer, nullable=False, default=0)
+    num_completed = Column(Integer, nullable=False, default=0)
+    last_utterance_idx = Column(Integer)
+    error = Column(Text)
+    date_created = Column(DateTime, nullable=False)
+    date_started = Column(DateTime)
+    date_updated = Column(DateTime)
+    date_completed = Column(DateTime)
+    translation_id = Column(Integer, ForeignKey("translation.id"))  # not set for playground jobs
+    translation = relationship("Translation")
@@ -127,3 +127,27 @@ class Speaker(SpeakerBase):
 
     class Config:
         orm_mode = True
+
+
+class SynthesisJobBase(BaseModel):
+    kind: str
+    priority: int
+    status: str
+    params: str
+    date_created: datetime
+
+
+class SynthesisJobCreate(SynthesisJobBase):
+    pass
+
+
+class SynthesisJob(SynthesisJobBase):
+    id: int
+    translation_id: int | None = None
+    num_total: int
+    num_completed: int
+    last_utterance_idx: int | None = None
+    error: str | None = None
+
+    class Config:
+        orm_mode = True
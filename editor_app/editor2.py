@@ -1,8 +1,11 @@
 import gradio as gr
 
 from config import cfg
+from db import models
+from db.database import engine
 from editor_app.tts import read, reread, load, combine, load_translation
 from editor_app.common import get_cross_projects
+from editor_app.jobs import get_job_progress, cancel_job, ensure_worker
 
 with gr.Blocks() as submitter:
     with gr.Row() as row0:
@@ -16,12 +19,19 @@ with gr.Blocks() as submitter:
 
         with gr.Column(scale=1) as col1:
             text = gr.Text(label='Text')
+            resume = gr.Checkbox(label='Resume interrupted synthesis')
             button = gr.Button(value='Go!', variant='primary')
+            job_id = gr.Number(visible=False, precision=0)
+            progress = gr.Text(label='Progress')
+            cancel_button = gr.Button(value='Cancel')
 
         load_translation_button.click(load_translation, inputs=[title, lang], outputs=[title, text, speakers])
-        button.click(fn=read, inputs=[title, lang, text], outputs=[title])
+        button.click(fn=read, inputs=[title, lang, text, resume], outputs=[title, job_id]).then(
+            fn=get_job_progress, inputs=[job_id], outputs=[progress])
+        cancel_button.click(fn=cancel_job, inputs=[job_id], outputs=[progress])
 
     submitter.load(get_cross_projects, outputs=[user_projects])
+    submitter.load(get_job_progress, inputs=[job_id], outputs=[progress], every=cfg.tts.jobs.poll_interval_sec)
 
 
 with gr.Blocks() as editor:
@@ -72,4 +82,7 @@ with gr.Blocks() as editor:
 
 if __name__ == '__main__':
     # submitter.launch(debug=True)
+    models.Base.metadata.create_all(bind=engine)
+    ensure_worker()
+    editor.queue(concurrency_count=cfg.editor.queue_concurrency)
     editor.launch(debug=True)
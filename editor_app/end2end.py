@@ -7,9 +7,11 @@ import numpy as np
 
 from sqlalchemy.orm import Session
 
+from db import crud
 from db.database import SessionLocal
 from editor_app.tts import read, combine, add_tgt_media_components, get_translation_wrapped
 from editor_app.common import get_cross_projects
+from editor_app.jobs import wait_for_job
 from editor_app.stt import transcribe, save_transcript, add_src_media_components, calculate_project_score
 from editor_app.translator import gradio_translate, save_translation
 from media_utils import get_youtube_embed_code, download_media, download_rss, media_extensions
@@ -25,7 +27,10 @@ def end2end_pipeline(file, media_link, project_name, src_lang, tgt_lang, options
     _ = save_transcript(project_name, src_text, src_lang, request)
     _, tgt_text, *_ = gradio_translate(project_name, tgt_lang, request)
     _ = save_translation(project_name, tgt_text, tgt_lang, request)
-    _ = read(project_name, tgt_lang, tgt_text, request)
+    _, job_id = read(project_name, tgt_lang, tgt_text, request=request)
+    db: Session = SessionLocal()
+    wait_for_job(db, crud.get_synthesis_job(db, job_id))
+    db.close()
     tgt_components = combine(project_name, tgt_lang, request)
     res = [*src_components, *tgt_components]
 
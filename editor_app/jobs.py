@@ -0,0 +1,106 @@
+import json
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy.orm import Session
+
+from config import cfg
+from db import crud, schemas
+from db.database import SessionLocal
+from db.models import SynthesisJob
+
+# interactive rereads run ahead of bulk reads, even in between utterances of a running read.
+read_priority = 0
+reread_priority = 10
+finished_statuses = ('completed', 'failed', 'cancelled')
+
+worker_thread: threading.Thread | None = None
+worker_thread_lock = threading.Lock()
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def submit_job(db: Session, kind: str, translation_id: int, priority: int, **params) -> SynthesisJob:
+    job_data = schemas.SynthesisJobCreate(kind=kind, priority=priority, status='queued',
+                                          params=json.dumps(params), date_created=datetime.now())
+    job = crud.create_synthesis_job(db, job_data, translation_id)
+    ensure_worker()
+    return job
+
+
+def ensure_worker():
+    """Starts a worker thread in the app process, unless jobs are run by a separate worker process:
+    python -m editor_app.tts_worker
+    Called on app startup, so jobs orphaned by a previous app process are failed before anything can resume them.
+    """
+    global worker_thread
+    if cfg.tts.jobs.separate_worker:
+        return
+    with worker_thread_lock:
+        if worker_thread is None or not worker_thread.is_alive():
+            db: Session = SessionLocal()
+            fail_orphaned_jobs(db)
+            db.close()
+            from editor_app.tts_worker import run_worker
+            worker_thread = threading.Thread(target=run_worker, name='tts_worker', daemon=True)
+            worker_thread.start()
+
+
+def fail_orphaned_jobs(db: Session):
+    """Jobs are only run by a single worker, whatever it left running or cancelling will never finish."""
+    for job in crud.get_synthesis_jobs_by_status(db, 'running') + crud.get_synthesis_jobs_by_status(db, 'cancelling'):
+        crud.update_any_db_row(db, job, status='failed', error='worker restarted', date_completed=datetime.now())
+
+
+def update_job_progress(db: Session, job: SynthesisJob, utterance_idx: int) -> SynthesisJob:
+    """Records a synthesized utterance, raises JobCancelled if cancellation was requested meanwhile."""
+    db.refresh(job)
+    if job.status == 'cancelling':
+        raise JobCancelled(f"Job {job.id} cancelled")
+    return crud.update_any_db_row(db, job, num_completed=job.num_completed + 1, last_utterance_idx=utterance_idx,
+                                  date_updated=datetime.now())
+
+
+def cancel_job(job_id: int) -> str:
+    db: Session = SessionLocal()
+    job = crud.get_synthesis_job(db, job_id)
+    if not job:
+        raise Exception(f"No such job {job_id}")
+    if job.status == 'queued':
+        crud.update_any_db_row(db, job, status='cancelled', date_completed=datetime.now())
+    elif job.status == 'running':
+        # running job stops on its next progress update
+        crud.update_any_db_row(db, job, status='cancelling')
+    progress = format_job_progress(job)
+    db.close()
+    return progress
+
+
+def format_job_progress(job: SynthesisJob) -> str:
+    progress = f"job {job.id} {job.kind}: {job.status}, {job.num_completed}/{job.num_total} utterances"
+    if job.error:
+        progress += f", error: {job.error}"
+    return progress
+
+
+def get_job_progress(job_id: int | None) -> str:
+    """One-shot status read, the editor polls it, so no queue worker is held for the duration of a job."""
+    if not job_id:
+        return ''
+    db: Session = SessionLocal()
+    job = crud.get_synthesis_job(db, job_id)
+    progress = format_job_progress(job) if job else f"No such job {job_id}"
+    db.close()
+    return progress
+
+
+def wait_for_job(db: Session, job: SynthesisJob) -> SynthesisJob:
+    while job.status not in finished_statuses:
+        time.sleep(cfg.tts.jobs.poll_interval_sec)
+        db.refresh(job)
+    if job.status != 'completed':
+        raise Exception(format_job_progress(job))
+    return job
@@ -7,10 +7,12 @@ from db import crud, models, schemas
 from db.database import SessionLocal, engine
 
 from .editor2 import submitter, editor
+from .jobs import ensure_worker
 from .transcriber import transcriber
 from .translator import translator
 
 models.Base.metadata.create_all(bind=engine)
+ensure_worker()
 
 app = FastAPI()
 
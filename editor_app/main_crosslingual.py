@@ -1,9 +1,14 @@
 import gradio as gr
 
+from config import cfg
+from db import models
+from db.database import engine
+
 from transcriber import transcriber
 from translator import translator
 from editor2 import submitter, editor
 from end2end import e2e
+from editor_app.jobs import ensure_worker
 
 with gr.Blocks() as cross_lingual:
     with gr.Tab("end2end") as e2e_tab:
@@ -22,5 +27,9 @@ user_db = [
 ]
 auth_msg = "Welcome to CrossLingual"
 if __name__ == '__main__':
+    models.Base.metadata.create_all(bind=engine)
+    ensure_worker()
+    # queue is needed for polling synthesis progress, rereads wait for their job in a queue worker.
+    cross_lingual.queue(concurrency_count=cfg.editor.queue_concurrency)
     cross_lingual.launch(auth=user_db, auth_message=auth_msg, server_name="0.0.0.0",
                          server_port=8000, show_error=True, debug=True)
@@ -1,19 +1,33 @@
+import hashlib
+import json
+import os
 import shutil
 import tempfile
-from collections import Counter
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from pathlib import Path
 
 import gradio as gr
+import numpy as np
 import soundfile as sf
+import torch
+import torchaudio
 import whisper
+import pyannote.audio
 from pyannote.audio import Pipeline
+from pyannote.core import Annotation, Segment
+from pyannote.database.util import load_rttm
 from sqlalchemy.orm import Session
 
-from media_utils import download_youtube_media, get_youtube_embed_code, media_has_video_steam, extract_audio, demucs_audio, resample_audio
+from media_utils import download_youtube_media, get_youtube_embed_code, media_has_video_steam, extract_audio, demucs_audio, \
+    resample_audio_variants, compute_file_hash, link_or_copy, get_media_duration, decode_audio
 from string_utils import validate_and_preprocess_title, get_random_string
 from utils import compute_string_similarity, get_user_from_request
-from utils import gradio_read_audio_data
-from config import cfg
+from utils import AudioWindowReader, SpeechTimeline, prefetch, detect_speech_regions, crop_speech_regions
+from utils import BackgroundConsumer
+from config import cfg, data_root
 from db import crud, schemas
 from db.database import SessionLocal
 from db.models import Utterance, CrossProject
@@ -25,6 +39,11 @@ else:
     stt_model = whisper.load_model(cfg.stt.model_size)
     diarization_model = Pipeline.from_pretrained(cfg.diarization.model_name, use_auth_token=cfg.diarization.auth_token)
 
+diarization_cache_root = data_root.joinpath("cache", "diarization")
+# whisper installs kv-cache hooks on the model for every decoding, so decodings must not run concurrently.
+stt_model_lock = threading.Lock()
+candidate_scorer_pool = ThreadPoolExecutor(max_workers=cfg.tts.scorer_pool_size, thread_name_prefix='candidate_scorer')
+
 
 def transcribe(input_media, media_link, project_name: str, language: str, options: list, request: gr.Request):
     """Transcribe input media with speaker diarization, resulting transcript will be in form:
@@ -45,49 +64,144 @@ def transcribe(input_media, media_link, project_name: str, language: str, option
     user = crud.get_user_by_email(db, user_email)
 
     cross_project = crud.get_cross_project_by_title(db, project_name, user.id, ensure_exists=False)
+    # interrupted transcription of an existing project is resumed from its checkpoint.
     if cross_project is not None:
-        raise Exception(f"CrossProject {project_name} already exists, pick another name")
-    if media_link is not None:
-        tmp_media_path = download_youtube_media(media_link, tempfile.gettempdir())
-        name = tmp_media_path.name
-    elif input_media is not None:
-        tmp_media_path = input_media.name
-        name = get_random_string()
+        if len(cross_project.transcript) > 0 or not cross_project.get_transcription_checkpoint_path().exists():
+            raise Exception(f"CrossProject {project_name} already exists, pick another name")
+        if input_media is not None or media_link:
+            raise Exception(f"Transcription of CrossProject {project_name} was interrupted, "
+                            f"rerun it without media to resume, or pick another name")
+        media_path = cross_project.get_media_path()
     else:
-        raise Exception(f"either media_link or media file should be provided")
+        if media_link is not None:
+            tmp_media_path = download_youtube_media(media_link, tempfile.gettempdir())
+            name = tmp_media_path.name
+        elif input_media is not None:
+            tmp_media_path = input_media.name
+            name = get_random_string()
+        else:
+            raise Exception(f"either media_link or media file should be provided")
 
-    # TODO refactor, I need to have media path before I create crosslingual db entry.
-    # TODO Add more checks and atomicity.
-    # TODO I don't want to manually cleanup disk and database if something went wrong while project creation.
+        # TODO refactor, I need to have media path before I create crosslingual db entry.
+        # TODO Add more checks and atomicity.
+        # TODO I don't want to manually cleanup disk and database if something went wrong while project creation.
 
-    cross_project_data = schemas.CrossProjectCreate(title=project_name, media_name=name)
-    cross_project = crud.create_cross_project(db, cross_project_data, user.id)
-    media_path = shutil.copy(tmp_media_path, cross_project.get_media_path())
+        cross_project_data = schemas.CrossProjectCreate(title=project_name, media_name=name)
+        cross_project = crud.create_cross_project(db, cross_project_data, user.id)
+        media_path = shutil.copy(tmp_media_path, cross_project.get_media_path())
+        # from here on, failed transcription can be resumed by rerunning it under the same project name.
+        cross_project.get_transcription_checkpoint_path().touch()
     wav_path = cross_project.get_raw_wav_path()
 
-    res_extract_audio = extract_audio(media_path, wav_path)
+    # demo runs only process a window of media, cropping it before separation and diarization.
+    crop_start_sec, crop_duration_sec = 0, None
+    if demo_run:
+        # unset ad offset for projects shorter than offset
+        if get_media_duration(media_path) >= (cfg.demo.ad_offset_sec + cfg.demo.duration_sec):
+            crop_start_sec = cfg.demo.ad_offset_sec
+        crop_duration_sec = cfg.demo.max_media_sec - crop_start_sec
+
+    res_extract_audio = extract_audio(media_path, wav_path, start_sec=crop_start_sec, duration_sec=crop_duration_sec)
     res_demucs = demucs_audio(wav_path)
 
     get_vocals_wav_path = cross_project.get_vocals_wav_path()
     wav_16k_path = cross_project.get_raw_wav_path(sample_rate=cfg.stt.sample_rate)
     wav_22k_path = cross_project.get_raw_wav_path(sample_rate=cfg.tts.spkr_emb_sample_rate)
-
-    res_resample_16k = resample_audio(get_vocals_wav_path, wav_16k_path, sample_rate=cfg.stt.sample_rate)
-    res_resample_22k = resample_audio(get_vocals_wav_path, wav_22k_path, sample_rate=cfg.tts.spkr_emb_sample_rate)
-
-    waveform_16k, _ = gradio_read_audio_data(wav_16k_path)
-    waveform_22k, _ = gradio_read_audio_data(wav_22k_path)
+    wav_24k_path = cross_project.get_raw_wav_path(sample_rate=cfg.tts.sample_rate)
+
+    if cfg.stt.streaming:
+        res_resample = resample_audio_variants(get_vocals_wav_path, {
+            cfg.stt.sample_rate: wav_16k_path,
+            cfg.tts.spkr_emb_sample_rate: wav_22k_path,
+            cfg.tts.sample_rate: wav_24k_path,
+        })
+        audio_16k = AudioWindowReader(wav_16k_path, streaming=True)
+        audio_22k = AudioWindowReader(wav_22k_path, streaming=True)
+    else:
+        # vocals are decoded once, straight into memory, the tts rate wav is written in the same ffmpeg pass,
+        # stt and speaker embedding rates are resampled from the decoded audio without intermediate wav files.
+        wav_24k = torch.from_numpy(decode_audio(get_vocals_wav_path, cfg.tts.sample_rate, write_path=wav_24k_path))
+        audio_16k = AudioWindowReader.from_waveform(
+            torchaudio.functional.resample(wav_24k, cfg.tts.sample_rate, cfg.stt.sample_rate), cfg.stt.sample_rate)
+        audio_22k = AudioWindowReader.from_waveform(
+            torchaudio.functional.resample(wav_24k, cfg.tts.sample_rate, cfg.tts.spkr_emb_sample_rate),
+            cfg.tts.spkr_emb_sample_rate)
+        del wav_24k
+
+    # diarization and stt only run on speech regions, timeline maps their time back to the source media.
+    speech_regions = np.array([[0, audio_16k.duration]])
+    if cfg.vad.enabled:
+        detected_regions = detect_speech_regions(audio_16k, threshold_db=cfg.vad.threshold_db,
+                                                 min_silence_sec=cfg.vad.min_silence_sec,
+                                                 min_speech_sec=cfg.vad.min_speech_sec, pad_sec=cfg.vad.pad_sec)
+        if len(detected_regions) > 0:
+            speech_regions = detected_regions
+            audio_16k = crop_speech_regions(audio_16k, speech_regions, wav_16k_path.with_suffix('.speech.wav'))
+            audio_22k = crop_speech_regions(audio_22k, speech_regions, wav_22k_path.with_suffix('.speech.wav'))
+    speech_timeline = SpeechTimeline(speech_regions, offset_sec=crop_start_sec)
+
+    diarization = diarize(audio_16k, get_vocals_wav_path, cross_project.get_diarization_path(), speech_regions)
+
+    tracks = []
+    for seg, _, speaker in diarization.itertracks(yield_label=True):
+        # diarization runs on concatenated speech regions, segments spanning a seam are split at it,
+        # otherwise their source timecodes would include the non-speech removed in between.
+        for start, end in speech_timeline.split(seg.start, seg.end):
+            tracks.append((len(tracks), Segment(start, end), speaker.lower()))
+
+    checkpoint = SegmentCheckpoint(cross_project.get_transcription_checkpoint_path())
+    completed_results = checkpoint.load(tracks)
+    pending = [i for i, (idx, _, _) in enumerate(tracks) if idx not in completed_results]
+
+    # in case of unspecified input language, detect it once for the whole project instead of every segment.
+    languages = [language] * len(tracks)
+    if language is None and cfg.stt.language_detection == 'project' and len(pending) > 0:
+        project_lang, speaker_langs = detect_languages(audio_16k, tracks)
+        if cfg.stt.per_speaker_language:
+            languages = [speaker_langs[speaker] for _, _, speaker in tracks]
+        else:
+            languages = [project_lang] * len(tracks)
+
+    # whisper decodes in the main thread, audio for upcoming batches is prefetched in the background
+    # and speaker samples are scored by a separate io thread, as soon as their segment is decoded.
+    speaker_store = SpeakerSampleStore(audio_22k, cross_project.id) if save_speakers else None
+    seg_results = [completed_results.get(idx) for idx, _, _ in tracks]
+    for i in range(len(tracks)):
+        if save_speakers and seg_results[i] is not None and len(seg_results[i]['text']) > 0:
+            speaker_store.submit(*tracks[i])
+
+    def decode_tracks(track_idxs):
+        pending = [i for i in track_idxs if seg_results[i] is None]
+        pending_segments = [tracks[i][1] for i in pending]
+        pending_languages = [languages[i] for i in pending]
+        for j, seg_res in iter_transcribed_segments(audio_16k, pending_segments, pending_languages):
+            i = pending[j]
+            checkpoint.append(*tracks[i], seg_res)
+            seg_results[i] = seg_res
+            if save_speakers and len(seg_res['text']) > 0:
+                speaker_store.submit(*tracks[i])
 
     if demo_run:
-        waveform_16k = waveform_16k[:(10*60*cfg.stt.sample_rate)]
-        waveform_22k = waveform_22k[:(10*60*cfg.tts.spkr_emb_sample_rate)]
-        # unset ad offset for projects shorter than offset
-        if len(waveform_16k) / cfg.stt.sample_rate < (cfg.demo.ad_offset_sec + cfg.demo.duration_sec):
-            ad_offset = -1
-        else:
-            ad_offset = cfg.demo.ad_offset_sec
+        # no need to decode segments which won't make it into the demo. Segments turn out empty only once decoded,
+        # so they're decoded in rounds, in time order, until non-empty ones cover the demo duration.
+        num_selected = 0
+        while num_selected < len(tracks):
+            speech_duration = sum(tracks[i][1].duration for i in range(num_selected)
+                                  if len(seg_results[i]['text']) > 0)
+            if speech_duration >= cfg.demo.duration_sec:
+                break
+            round_start, candidates_duration = num_selected, 0
+            while num_selected < len(tracks) and candidates_duration < cfg.demo.duration_sec - speech_duration:
+                candidates_duration += tracks[num_selected][1].duration
+                num_selected += 1
+            decode_tracks(range(round_start, num_selected))
+    else:
+        decode_tracks(range(len(tracks)))
+    if save_speakers:
+        speaker_store.close()
+    # transcription is complete, the project can't be resumed anymore.
+    checkpoint.complete()
 
-    diarization = diarization_model({'waveform': waveform_16k.unsqueeze(0), 'sample_rate': cfg.stt.sample_rate})
     demo_duration = 0
     res_text, ffmpeg_str = '', ''
     segments, speaker_samples = [], dict()
@@ -95,36 +209,26 @@ def transcribe(input_media, media_link, project_name: str, language: str, option
     # this is a reason for using a counter
     detected_languages = Counter()
 
-    for idx, (seg, _, speaker) in enumerate(diarization.itertracks(yield_label=True)):
+    for (idx, seg, speaker), seg_res in zip(tracks, seg_results):
+        if seg_res is None:
+            # demo segments past the decoded ones
+            break
 
-        if demo_run:
-            if seg.start < ad_offset:
-                continue
-        speaker = speaker.lower()
-        seg_wav_16k = waveform_16k[int(seg.start * cfg.stt.sample_rate): int(seg.end * cfg.stt.sample_rate)]
-        seg_wav_22k = waveform_22k[int(seg.start * cfg.tts.spkr_emb_sample_rate): int(seg.end * cfg.tts.spkr_emb_sample_rate)]
-        decode_options = whisper.DecodingOptions(fp16=cfg.stt.half_precision,
-                                                 language=language)
-        seg_res = stt_model.transcribe(seg_wav_16k, **decode_options.__dict__)
+        # segments are relative to the cropped speech only audio, timecodes are kept relative to the source media.
+        src_seg = Segment(speech_timeline.to_source(seg.start), speech_timeline.to_source(seg.end, is_end=True))
         text = seg_res['text']
         if len(text) == 0:
             continue
         lang = seg_res['language']
-        segments.append([seg, speaker, text, lang])
-        res_text += f"{seg}\n{{{speaker}}}\n{text}\n\n"
+        segments.append([src_seg, speaker, text, lang])
+        res_text += f"{src_seg}\n{{{speaker}}}\n{text}\n\n"
         detected_languages[lang] += 1
 
         if save_speakers:
-            seg_name = f'output_{idx:03}.wav'
-            db_spkr = crud.get_speaker_by_name(db, speaker, cross_project.id)
-            if not db_spkr:
-                db_spkr = crud.create_speaker(db, speaker, cross_project.id)
-            seg_path = db_spkr.get_speaker_data_root().joinpath(seg_name)
-            sf.write(seg_path, seg_wav_22k, cfg.tts.spkr_emb_sample_rate)
-            ffmpeg_str += f' -ss {seg.start} -to {seg.end} -c copy {seg_name}'
+            ffmpeg_str += f' -ss {src_seg.start} -to {src_seg.end} -c copy output_{idx:03}.wav'
 
         if speaker not in speaker_samples:
-            speaker_samples[speaker] = seg
+            speaker_samples[speaker] = src_seg
 
         if demo_run:
             demo_duration += (seg.end - seg.start)
@@ -147,6 +251,227 @@ def transcribe(input_media, media_link, project_name: str, language: str, option
     return results
 
 
+def diarize(audio: AudioWindowReader, vocals_wav_path: Path, project_rttm_path: Path,
+            speech_regions: np.ndarray) -> Annotation:
+    """Runs speaker diarization, or loads its result from the cache.
+    Results are stored as RTTM keyed by the vocals content, the diarized number of frames, speech regions
+    and the pipeline version,
+    so retries and resubmissions of the same media skip diarization. A copy is kept next to the project.
+    """
+    pipeline_version = f"{cfg.diarization.model_name}:pyannote.audio-{pyannote.audio.__version__}"
+    regions_hash = hashlib.sha256(np.ascontiguousarray(speech_regions, dtype=np.float64).tobytes()).hexdigest()
+    cache_key = hashlib.sha256(
+        f"{compute_file_hash(vocals_wav_path)}:{audio.num_frames}:{regions_hash}:{pipeline_version}".encode()
+    ).hexdigest()
+    rttm_path = diarization_cache_root.joinpath(f"{cache_key}.rttm")
+
+    if not (cfg.diarization.cache and rttm_path.exists()):
+        diarization = diarization_model(audio.diarization_input())
+        rttm_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_rttm_path = rttm_path.with_suffix(f".{get_random_string()}.tmp")
+        with open(tmp_rttm_path, 'w') as f:
+            diarization.write_rttm(f)
+        os.replace(tmp_rttm_path, rttm_path)
+    # fresh results are read back as well, RTTM rounds segment bounds,
+    # so fresh and cached runs give identical segments and checkpoints of either match on resume.
+    # uri is the only key in a single file RTTM, empty RTTM means no speech was found.
+    diarization = next(iter(load_rttm(rttm_path).values()), Annotation())
+
+    link_or_copy(rttm_path, project_rttm_path)
+    return diarization
+
+
+def compute_mel(audio: AudioWindowReader, seg: Segment) -> torch.Tensor:
+    seg_wav = whisper.pad_or_trim(audio.crop(seg.start, seg.end))
+    return whisper.log_mel_spectrogram(seg_wav, n_mels=stt_model.dims.n_mels)
+
+
+def detect_languages(audio: AudioWindowReader, tracks: list) -> tuple[str, dict[str, str]]:
+    """Detects language on a few of the longest segments of every speaker.
+    Returns the project language, most probable over all speakers, and the language of every speaker.
+    """
+    speaker_segments = defaultdict(list)
+    for _, seg, speaker in tracks:
+        speaker_segments[speaker].append(seg)
+
+    project_probs = Counter()
+    speaker_languages = dict()
+    for speaker, segs in speaker_segments.items():
+        segs = sorted(segs, key=lambda x: x.duration, reverse=True)[:cfg.stt.language_detection_windows]
+        mel_batch = torch.stack([compute_mel(audio, seg) for seg in segs]).to(stt_model.device)
+        with stt_model_lock:
+            _, lang_probs = stt_model.detect_language(mel_batch)
+        speaker_probs = Counter()
+        for probs in lang_probs:
+            speaker_probs.update(probs)
+        speaker_languages[speaker] = speaker_probs.most_common(1)[0][0]
+        project_probs.update(speaker_probs)
+    return project_probs.most_common(1)[0][0], speaker_languages
+
+
+def iter_transcribed_segments(audio: AudioWindowReader, segments: list, languages: list[str | None]):
+    """Transcribe diarized segments in padded batches instead of one stt_model.transcribe call per segment.
+    Segments are bucketed by language and length, so decoding within a batch finishes at a similar step.
+    Segments with None language have their language detected by whisper.
+    Audio reading and mel computation for upcoming batches run in a background thread,
+    at most cfg.stt.prefetch_batches batches are held in memory.
+    Yields (segment index, result) pairs in completion order, results are dicts with 'text' and 'language' keys.
+    Segments longer than whisper's 30 sec window fall back to stt_model.transcribe.
+    """
+    def get_decode_options(language):
+        return whisper.DecodingOptions(fp16=cfg.stt.half_precision, language=language)
+
+    def transcribe_segment(i: int) -> dict:
+        seg = segments[i]
+        with stt_model_lock:
+            return stt_model.transcribe(audio.crop(seg.start, seg.end), **get_decode_options(languages[i]).__dict__)
+
+    if cfg.stt.batch_size <= 1:
+        for i in range(len(segments)):
+            yield i, transcribe_segment(i)
+        return
+
+    window_sec = whisper.audio.N_SAMPLES / whisper.audio.SAMPLE_RATE
+    lang_to_idxs = defaultdict(list)
+    for i, seg in enumerate(segments):
+        if seg.duration > window_sec:
+            yield i, transcribe_segment(i)
+        else:
+            lang_to_idxs[languages[i]].append(i)
+
+    batches = []
+    for idxs in lang_to_idxs.values():
+        idxs = sorted(idxs, key=lambda i: segments[i].duration)
+        batches.extend(idxs[s: s + cfg.stt.batch_size] for s in range(0, len(idxs), cfg.stt.batch_size))
+
+    def compute_mels(batch_idxs: list[int]) -> torch.Tensor:
+        return torch.stack([compute_mel(audio, segments[i]) for i in batch_idxs])
+
+    for batch_idxs, mel_batch in prefetch(batches, compute_mels, cfg.stt.prefetch_batches):
+        decode_options = get_decode_options(languages[batch_idxs[0]])
+        with stt_model_lock:
+            batch_res = stt_model.decode(mel_batch.to(stt_model.device), decode_options)
+        for i, res in zip(batch_idxs, batch_res):
+            text = res.text
+            # same silence heuristic as in whisper.transcribe
+            if res.no_speech_prob > 0.6 and res.avg_logprob < -1.0:
+                text = ''
+            yield i, {'text': text, 'language': res.language}
+
+
+class SegmentCheckpoint:
+    """Append-only log of transcribed segments, one json line per segment,
+    so transcription interrupted midway resumes from the segments completed so far.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    def load(self, tracks: list) -> dict[int, dict]:
+        """Returns results of completed segments by their diarization idx,
+        entries which don't match current diarization are ignored."""
+        if not self.path.exists():
+            return dict()
+        idx_to_track = {idx: (round(seg.start, 3), round(seg.end, 3), speaker) for idx, seg, speaker in tracks}
+        results = dict()
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # last line could be partially written
+                    continue
+                if idx_to_track.get(entry['idx']) == (entry['start'], entry['end'], entry['speaker']):
+                    results[entry['idx']] = {'text': entry['text'], 'language': entry['language']}
+        return results
+
+    def complete(self):
+        """Keeps the log for reference under a name which isn't resumed from."""
+        if self.path.exists():
+            os.replace(self.path, self.path.with_suffix('.completed.jsonl'))
+
+    def append(self, idx: int, seg: Segment, speaker: str, seg_res: dict):
+        entry = {
+            'idx': idx,
+            'start': round(seg.start, 3),
+            'end': round(seg.end, 3),
+            'speaker': speaker,
+            'text': seg_res['text'],
+            'language': seg_res['language'],
+        }
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+
+def score_speaker_sample(wav: np.ndarray, sample_rate: int) -> float:
+    """Reference sample quality, longer and louder samples are better, clipped samples are penalized."""
+    duration_score = min(len(wav) / sample_rate, cfg.speaker_samples.clip_sec) / cfg.speaker_samples.clip_sec
+    rms_db = 20 * np.log10(np.sqrt(np.mean(wav ** 2)) + 1e-10)
+    # -50 dBFS and lower is as bad as silence, -10 dBFS and higher is as good as it gets.
+    energy_score = np.clip((rms_db + 50) / 40, 0, 1)
+    clipping_ratio = np.mean(np.abs(wav) >= 0.99)
+    return float(duration_score + 0.5 * energy_score - 10 * clipping_ratio)
+
+
+class SpeakerSampleStore(BackgroundConsumer):
+    """Keeps a bounded set of reference samples per speaker.
+    Segments are scored in a background io thread as soon as they're decoded, so whisper doesn't wait on disk and db.
+    On close, the best segments of every speaker are packed into clips of cfg.speaker_samples.clip_sec,
+    up to cfg.speaker_samples.budget_sec of audio per speaker, so computing conditioning latents
+    takes the same time regardless of media duration. Uses its own db session.
+    """
+
+    def __init__(self, audio: AudioWindowReader, cross_project_id: int, max_pending: int = 64):
+        self.audio = audio
+        self.cross_project_id = cross_project_id
+        self.candidates = defaultdict(list)
+        self.db: Session = SessionLocal()
+        super().__init__(max_pending)
+
+    def submit(self, idx: int, seg: Segment, speaker: str):
+        super().submit((idx, seg, speaker))
+
+    def consume(self, item):
+        idx, seg, speaker = item
+        score = score_speaker_sample(self.audio.crop(seg.start, seg.end).numpy(), self.audio.sample_rate)
+        self.candidates[speaker].append((score, seg))
+
+    def finish(self):
+        self._write_references(self.db)
+
+    def teardown(self):
+        self.db.close()
+
+    def _write_references(self, db: Session):
+        clip_len = int(cfg.speaker_samples.clip_sec * self.audio.sample_rate)
+        budget_len = int(cfg.speaker_samples.budget_sec * self.audio.sample_rate)
+        for speaker, candidates in self.candidates.items():
+            db_spkr = crud.get_speaker_by_name(db, speaker, self.cross_project_id)
+            if not db_spkr:
+                db_spkr = crud.create_speaker(db, speaker, self.cross_project_id)
+            speaker_root = db_spkr.get_speaker_data_root()
+            # samples left by an interrupted run
+            for old_sample_path in speaker_root.glob('*.wav'):
+                old_sample_path.unlink()
+
+            clips, cur_clip, cur_len, total_len = [], [], 0, 0
+            for _, seg in sorted(candidates, key=lambda x: x[0], reverse=True):
+                if total_len >= budget_len:
+                    break
+                wav = self.audio.crop(seg.start, seg.end).numpy()[:budget_len - total_len]
+                if cur_clip and cur_len + len(wav) > clip_len:
+                    clips.append(np.concatenate(cur_clip))
+                    cur_clip, cur_len = [], 0
+                cur_clip.append(wav)
+                cur_len += len(wav)
+                total_len += len(wav)
+            if cur_clip:
+                clips.append(np.concatenate(cur_clip))
+
+            for clip_idx, clip in enumerate(clips):
+                sf.write(speaker_root.joinpath(f'reference_{clip_idx:03}.wav'), clip, self.audio.sample_rate)
+
+
 def add_src_media_components(cross_project: CrossProject, media_link: str | None):
     res = []
     if media_link:
@@ -196,7 +521,8 @@ def save_transcript(project_name: str, text: str, lang: str, request: gr.Request
 
 
 def transcribe_utterance(utterance: Utterance, language=None):
-    seg_res = stt_model.transcribe(str(utterance.get_audio_path()), language=language)
+    with stt_model_lock:
+        seg_res = stt_model.transcribe(str(utterance.get_audio_path()), language=language)
     text = seg_res['text']
     lang = seg_res['language']
     return text, lang
@@ -213,6 +539,56 @@ def compute_and_store_score(db, utterance, lang=None) -> float:
     return score
 
 
+def compute_candidate_mel(wav: np.ndarray, sample_rate: int) -> torch.Tensor:
+    audio = torchaudio.functional.resample(torch.from_numpy(wav).float(), sample_rate, whisper.audio.SAMPLE_RATE)
+    return whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), n_mels=stt_model.dims.n_mels)
+
+
+def score_candidates(text: str, wavs: list[np.ndarray], sample_rate: int, language=None) -> list[tuple[str, float]]:
+    """Transcribes synthesized candidates of the text and scores them with compute_string_similarity.
+    Resampling, mels and scores are computed in candidate_scorer_pool, whisper decodes all candidates as one batch.
+    Returns (stt text, score) of every candidate.
+    """
+    mels = list(candidate_scorer_pool.map(lambda wav: compute_candidate_mel(wav, sample_rate), wavs))
+    decode_options = whisper.DecodingOptions(fp16=cfg.stt.half_precision, language=language)
+    with stt_model_lock:
+        results = stt_model.decode(torch.stack(mels).to(stt_model.device), decode_options)
+    stt_texts = [res.text for res in results]
+    scores = candidate_scorer_pool.map(lambda stt_text: compute_string_similarity(text, stt_text), stt_texts)
+    return list(zip(stt_texts, scores))
+
+
+def store_scores(db, utterance, scores: list[tuple[str, float]]):
+    """Stores scores of all candidates of the utterance, the last one is taken as the utterance score."""
+    for stt_text, score in scores:
+        utter_stt = schemas.UtteranceSTTCreate(orig_utterance_id=utterance.id,
+                                               text=stt_text,
+                                               levenstein_similarity=score,
+                                               date=datetime.now())
+        crud.create_utterance_stt(db, utter_stt)
+
+
+class UtteranceScorer(BackgroundConsumer):
+    """Scores synthesized utterances in a background thread, so synthesis doesn't wait for whisper.
+    Scores are stored in utterance_stt as with compute_and_store_score. Uses its own db session.
+    """
+
+    def __init__(self, max_pending: int = 64):
+        self.db: Session = SessionLocal()
+        super().__init__(max_pending)
+
+    def submit(self, utterance_id: int, lang=None):
+        super().submit((utterance_id, lang))
+
+    def consume(self, item):
+        utterance_id, lang = item
+        utterance = self.db.query(Utterance).filter(Utterance.id == utterance_id).first()
+        compute_and_store_score(self.db, utterance, lang=lang)
+
+    def teardown(self):
+        self.db.close()
+
+
 def get_or_compute_score(db, utterance) -> float:
     key_func = lambda x: x.date
     stt_utterances = sorted(utterance.utterance_stt, key=key_func)
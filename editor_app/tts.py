@@ -1,41 +1,254 @@
 import bisect
+import hashlib
 import json
-from collections import defaultdict
+import os
+import pathlib
+import shutil
+import threading
+from collections import OrderedDict, defaultdict
 from datetime import datetime
+from types import SimpleNamespace
+from typing import Callable
 
 import gradio as gr
 import soundfile as sf
 import numpy as np
 import torch
+import torch.nn.functional as F
 from sqlalchemy.orm import Session
 
-from tortoise.api import TextToSpeech
+from tortoise.api import TextToSpeech, load_discrete_vocoder_diffuser, do_spectrogram_diffusion, \
+    fix_autoregressive_output
 from tortoise.utils.audio import load_voices
 from tortoise.utils.text import split_and_recombine_text
 from tortoise.utils.wav2vec_alignment import Wav2VecAlignment
 
-from config import cfg
-from media_utils import convert_wav_to_mp3_ffmpeg, media_has_video_steam, mux_video_audio
-from string_utils import validate_and_preprocess_title
+from config import cfg, data_root
+from media_utils import convert_wav_to_mp3_ffmpeg, media_has_video_steam, mux_video_audio, compute_file_hash
+from string_utils import validate_and_preprocess_title, get_random_string
 from utils import compute_string_similarity, split_on_raw_utterances, time_re, normalize_text, \
-    find_single_repetition, get_user_from_request
+    find_single_repetition, get_user_from_request, plan_incremental_render, layout_timeline, time_compress
 from datatypes import RawUtterance
 from db import crud, schemas
 from .common import get_speakers
+from .jobs import submit_job, wait_for_job, read_priority, reread_priority
 from db.database import SessionLocal
-from db.models import Utterance, Translation
-from .stt import stt_model, compute_and_store_score, get_or_compute_score, calculate_project_score
+from db.models import Utterance, Translation, Speaker, SynthesisJob, User
+from .stt import stt_model, stt_model_lock, compute_and_store_score, get_or_compute_score, calculate_project_score, UtteranceScorer, \
+    score_candidates, store_scores
 
-if cfg.general.sysname == "Darwin":
-    tts_model = None
-    aligner = None
-else:
+tts_model = None
+aligner = None
+
+
+def load_tts_models():
+    global tts_model, aligner
     tts_model = TextToSpeech()
     aligner = Wav2VecAlignment()
 
 
-def read(title, lang, raw_text, request: gr.Request=None):
-    check_for_repetitions = False
+# a separate synthesis worker process owns the models, see editor_app.tts_worker
+if cfg.general.sysname != "Darwin" and not cfg.tts.jobs.separate_worker:
+    load_tts_models()
+
+
+def get_tortoise_settings(preset: str) -> dict:
+    """Settings tts_with_preset of the installed tortoise passes to tts for the preset.
+    Batched synthesis calls tortoise stages directly and needs them as well.
+    """
+    settings_recorder = SimpleNamespace(tts=lambda text, **settings: settings)
+    return TextToSpeech.tts_with_preset(settings_recorder, '', preset=preset)
+
+
+latents_lru = OrderedDict()
+latents_lru_lock = threading.Lock()
+synthesis_cache_root = data_root.joinpath("cache", "tts")
+
+
+def get_conditioning_latents(speaker: Speaker) -> tuple[torch.Tensor, torch.Tensor]:
+    """Tortoise conditioning latents of the speaker, computed once per set of reference samples.
+    Latents are keyed by names, sizes and modification times of the samples,
+    persisted next to the speaker data root and kept in an in-process LRU on top.
+    """
+    speaker_root = speaker.get_speaker_data_root()
+    sample_stats = [(p.name, p.stat().st_size, p.stat().st_mtime_ns) for p in sorted(speaker_root.iterdir())]
+    samples_key = hashlib.sha256(json.dumps(sample_stats).encode()).hexdigest()
+    lru_key = (str(speaker_root), samples_key)
+
+    with latents_lru_lock:
+        if lru_key in latents_lru:
+            latents_lru.move_to_end(lru_key)
+            return latents_lru[lru_key]
+
+    latents_path = speaker.get_latents_path()
+    latents = None
+    if latents_path.exists():
+        cached = torch.load(latents_path)
+        if cached['samples_key'] == samples_key:
+            latents = cached['latents']
+    if latents is None:
+        voice_samples, _ = load_voices([speaker.name], [speaker_root.parent])
+        latents = tuple(latent.cpu() for latent in tts_model.get_conditioning_latents(voice_samples))
+        torch.save({'samples_key': samples_key, 'latents': latents}, latents_path)
+
+    with latents_lru_lock:
+        latents_lru[lru_key] = latents
+        if len(latents_lru) > cfg.tts.latents_cache_size:
+            latents_lru.popitem(last=False)
+    return latents
+
+
+def hash_latents(latents: tuple[torch.Tensor, torch.Tensor]) -> str:
+    hasher = hashlib.sha256()
+    for latent in latents:
+        hasher.update(latent.cpu().numpy().tobytes())
+    return hasher.hexdigest()
+
+
+def get_synthesis_cache_path(text: str, latents_key: str, seed: int) -> pathlib.Path:
+    """Unbatched synthesis with a seed is fully determined by the text, voice, decoding parameters and seed.
+    Only whitespace is normalized, punctuation and case drive tortoise prosody.
+    """
+    key = json.dumps([' '.join(text.split()), latents_key, cfg.tts.preset, cfg.tts.num_autoregressive_samples, seed,
+                      cfg.tts.candidates])
+    return synthesis_cache_root.joinpath(f"{hashlib.sha256(key.encode()).hexdigest()}.wav")
+
+
+def synthesize_best_candidate(text: str, conditioning_latents: tuple[torch.Tensor, torch.Tensor],
+                              use_deterministic_seed: int | None,
+                              language=None) -> tuple[np.ndarray, list[tuple[str, float]] | None]:
+    """Synthesizes cfg.tts.candidates candidates and keeps the one whisper transcribes closest to the text.
+    Returns the best candidate and (stt text, score) of all candidates with the best one last,
+    scores are None for a single candidate, which is scored as usual.
+    """
+    gen = tts_model.tts_with_preset(text, voice_samples=None, conditioning_latents=conditioning_latents,
+                                    preset=cfg.tts.preset, k=cfg.tts.candidates,
+                                    use_deterministic_seed=use_deterministic_seed,
+                                    num_autoregressive_samples=cfg.tts.num_autoregressive_samples)
+    if cfg.tts.candidates == 1:
+        return gen.cpu().numpy().squeeze(), None
+
+    gens = [g.cpu().numpy().squeeze() for g in gen]
+    scores = score_candidates(text, gens, cfg.tts.sample_rate, language)
+    best = max(range(len(gens)), key=lambda i: scores[i][1])
+    order = [i for i in range(len(gens)) if i != best] + [best]
+    return gens[best], [scores[i] for i in order]
+
+
+def is_batched_synthesis() -> bool:
+    # several candidates per utterance are synthesized one utterance at a time
+    return cfg.tts.batch_size > 1 and cfg.tts.candidates == 1
+
+
+def get_synthesis_batches(data: list[RawUtterance], pending_idxs: list[int]) -> list[list[int]]:
+    """Groups utterance indices into batches of a single speaker and similar text length.
+    Without batched synthesis, every pending utterance is a batch of its own, in original order.
+    Audio of batched synthesis depends on the whole batch, so batches are formed over all utterances,
+    which makes them a function of the text and cfg.tts.batch_size only, and every batch with a pending utterance
+    is returned whole. Reruns and resumed jobs then produce the same audio as an uninterrupted run.
+    """
+    if not is_batched_synthesis():
+        return [[idx] for idx in pending_idxs]
+
+    speaker_to_idxs = defaultdict(list)
+    for idx, utter in enumerate(data):
+        speaker_to_idxs[utter.speaker].append(idx)
+    batches = []
+    for idxs in speaker_to_idxs.values():
+        idxs = sorted(idxs, key=lambda idx: len(data[idx].text))
+        batches.extend(idxs[s: s + cfg.tts.batch_size] for s in range(0, len(idxs), cfg.tts.batch_size))
+    pending_idxs = set(pending_idxs)
+    return [batch for batch in batches if any(idx in pending_idxs for idx in batch)]
+
+
+def trim_calm_tokens(codes: torch.Tensor, latents: torch.Tensor, calm_token: int = 83) -> torch.Tensor:
+    # same as in tortoise tts, trim latents on a run of "calm" tokens, which is silence at the end of speech.
+    num_calm_tokens = 0
+    for i in range(codes.shape[-1]):
+        num_calm_tokens = num_calm_tokens + 1 if codes[i] == calm_token else 0
+        if num_calm_tokens > 8:
+            return latents[:i]
+    return latents
+
+
+def tts_batch(texts: list[str], conditioning_latents: tuple[torch.Tensor, torch.Tensor], preset: str,
+              use_deterministic_seed: int | None, num_autoregressive_samples: int,
+              max_mel_tokens: int = 500) -> list[np.ndarray]:
+    """Batched counterpart of tts_model.tts_with_preset with k=1, for several texts of the same speaker.
+    Autoregressive sampling runs over all texts at once, shorter texts are padded with the stop token,
+    so texts of a batch should be of similar length. CLVP ranking is done per text.
+    Diffusion runs as one batch with latents padded to the longest one, every mel is cropped to its own length.
+    The batch is seeded with use_deterministic_seed, so results are deterministic for a given batch,
+    see get_synthesis_batches for how batches are kept the same across runs.
+    """
+    settings = {**get_tortoise_settings(preset), 'num_autoregressive_samples': num_autoregressive_samples}
+    tts_model.deterministic_state(seed=use_deterministic_seed)
+    device = tts_model.device
+    autoregressive = tts_model.autoregressive
+    auto_conditioning, diffusion_conditioning = (latent.to(device) for latent in conditioning_latents)
+
+    # tortoise pads text tokens with 0, which is the stop token.
+    texts_tokens = [F.pad(torch.IntTensor(tts_model.tokenizer.encode(text)), (0, 1)) for text in texts]
+    max_text_len = max(len(tokens) for tokens in texts_tokens)
+    text_batch = torch.stack([F.pad(tokens, (0, max_text_len - len(tokens))) for tokens in texts_tokens]).to(device)
+    num_texts = len(texts)
+    num_return_sequences = max(1, tts_model.autoregressive_batch_size // num_texts)
+
+    with torch.no_grad():
+        samples = [[] for _ in texts]
+        num_samples = 0
+        while num_samples < settings['num_autoregressive_samples']:
+            codes = autoregressive.inference_speech(auto_conditioning.repeat(num_texts, 1), text_batch,
+                                                    do_sample=True, top_p=settings['top_p'],
+                                                    temperature=settings['temperature'],
+                                                    num_return_sequences=num_return_sequences,
+                                                    length_penalty=settings['length_penalty'],
+                                                    repetition_penalty=settings['repetition_penalty'],
+                                                    max_generate_length=max_mel_tokens)
+            codes = F.pad(codes, (0, max_mel_tokens - codes.shape[1]), value=autoregressive.stop_mel_token)
+            # sequences of every input text come in a row
+            for i in range(num_texts):
+                samples[i].append(codes[i * num_return_sequences: (i + 1) * num_return_sequences])
+            num_samples += num_return_sequences
+
+        best_latents = []
+        for text_tokens, text_samples in zip(texts_tokens, samples):
+            text_tokens = text_tokens.unsqueeze(0).to(device)
+            codes = torch.cat(text_samples, dim=0)
+            for i in range(codes.shape[0]):
+                codes[i] = fix_autoregressive_output(codes[i], autoregressive.stop_mel_token)
+            clvp_scores = tts_model.clvp(text_tokens.repeat(codes.shape[0], 1), codes, return_loss=False)
+            best_codes = codes[clvp_scores.argmax()].unsqueeze(0)
+            latents = autoregressive(auto_conditioning, text_tokens,
+                                     torch.tensor([text_tokens.shape[-1]], device=device), best_codes,
+                                     torch.tensor([best_codes.shape[-1] * autoregressive.mel_length_compression],
+                                                  device=device),
+                                     return_latent=True, clip_inputs=False)
+            best_latents.append(trim_calm_tokens(best_codes[0], latents[0]))
+
+        # padding repeats the last latent frame, padded part of mels is cropped.
+        max_latent_len = max(len(latents) for latents in best_latents)
+        latents_batch = torch.stack([torch.cat([latents, latents[-1:].repeat(max_latent_len - len(latents), 1)])
+                                     for latents in best_latents])
+        diffuser = load_discrete_vocoder_diffuser(desired_diffusion_steps=settings['diffusion_iterations'],
+                                                  cond_free=settings.get('cond_free', True),
+                                                  cond_free_k=settings['cond_free_k'])
+        mels = do_spectrogram_diffusion(tts_model.diffusion, diffuser, latents_batch,
+                                        diffusion_conditioning.repeat(num_texts, 1),
+                                        temperature=settings['diffusion_temperature'], verbose=False)
+        gens = []
+        for mel, latents in zip(mels, best_latents):
+            # same latents to mel length conversion as in do_spectrogram_diffusion
+            mel_len = len(latents) * 4 * 24000 // 22050
+            wav = tts_model.vocoder.inference(mel[:, :mel_len].unsqueeze(0))
+            gens.append(wav.cpu().numpy().squeeze())
+    return gens
+
+
+def read(title, lang, raw_text, resume=False, request: gr.Request=None):
+    """Submits synthesis of the translation to the job queue, returns title and job id to follow the progress.
+    With resume, an interrupted synthesis is completed, only utterances without audio are synthesized.
+    """
     user_email = get_user_from_request(request)
     title = validate_and_preprocess_title(title)
     db: Session = SessionLocal()
@@ -45,9 +258,98 @@ def read(title, lang, raw_text, request: gr.Request=None):
         # raise Exception(f"Project {title} already exists! Try to load it")
         raise Exception(f"At the moment only {title} existing translations are supported.")
 
-    if len(translation.utterances) > 0:
-        raise Exception(f"Project already synthesized or in progress, navigate to Edit tab")
+    if crud.get_active_synthesis_job(db, translation.id, 'read'):
+        raise Exception(f"Project synthesis in progress, navigate to Edit tab")
+    if len(translation.utterances) > 0 and not resume:
+        raise Exception(f"Project already synthesized or interrupted, resume it or navigate to Edit tab")
+
+    job = submit_job(db, 'read', translation.id, read_priority, raw_text=raw_text)
+    job_id = job.id
+    db.close()
+    return title, job_id
+
+
+def is_utterance_completed(utterance: Utterance | None) -> bool:
+    return utterance is not None and utterance.date_completed is not None and utterance.get_audio_path().exists()
+
+
+def synthesize_utterances(db: Session, translation: Translation, data: list[RawUtterance], pending_idxs: list[int],
+                          idx_to_utterance: dict[int, Utterance], speakers_to_features: dict,
+                          scorer: UtteranceScorer, on_progress: Callable[[int], None]):
+
+    def store_utterance(idx: int, gen_start: datetime, gen: np.ndarray = None, cache_path: pathlib.Path = None,
+                        candidate_scores: list[tuple[str, float]] = None):
+        utter = data[idx]
+        speaker_id = speakers_to_features[utter.speaker]['id']
+        if utterance := idx_to_utterance.get(idx):
+            utterance = crud.update_any_db_row(db, utterance, speaker_id=speaker_id, date_started=gen_start,
+                                               timecode=utter.timecode)
+        else:
+            utterance_data = schemas.UtteranceCreate(text=utter.text, utterance_idx=idx,
+                                                     date_started=gen_start, timecode=utter.timecode)
+            utterance = crud.create_utterance(db, utterance_data, translation.id, speaker_id)
+        if gen is not None:
+            sf.write(utterance.get_audio_path(), gen, cfg.tts.sample_rate)
+            if cache_path is not None:
+                # interrupted copy never shows up as a cache entry
+                tmp_cache_path = cache_path.with_suffix(f".{get_random_string()}.tmp")
+                shutil.copyfile(utterance.get_audio_path(), tmp_cache_path)
+                os.replace(tmp_cache_path, cache_path)
+        else:
+            # copy, not link, rereads overwrite utterance audio in place.
+            shutil.copyfile(cache_path, utterance.get_audio_path())
+        crud.update_any_db_row(db, utterance, date_completed=datetime.now())
+        if candidate_scores:
+            store_scores(db, utterance, candidate_scores)
+        else:
+            scorer.submit(utterance.id)
+        on_progress(idx)
+
+    # repeated phrases are synthesized once, within the translation and across runs.
+    # unseeded output and output of batched synthesis, which depends on the rest of the batch, is never cached.
+    cache_paths = dict()
+    if cfg.tts.cache and cfg.tts.seed is not None and not is_batched_synthesis():
+        synthesis_cache_root.mkdir(parents=True, exist_ok=True)
+        for idx in pending_idxs:
+            utter = data[idx]
+            cache_paths[idx] = get_synthesis_cache_path(utter.text, speakers_to_features[utter.speaker]['latents_key'],
+                                                        cfg.tts.seed)
+    synth_idxs, cached_idxs, synth_paths = [], [], set()
+    for idx in pending_idxs:
+        cache_path = cache_paths.get(idx)
+        if cache_path is not None and (cache_path in synth_paths or cache_path.exists()):
+            cached_idxs.append(idx)
+        else:
+            synth_idxs.append(idx)
+            synth_paths.add(cache_path)
+
+    synth_idxs_set = set(synth_idxs)
+    for batch_idxs in get_synthesis_batches(data, synth_idxs):
+        gen_start = datetime.now()
+        speaker = data[batch_idxs[0]].speaker
+        if len(batch_idxs) == 1:
+            gen, candidate_scores = synthesize_best_candidate(data[batch_idxs[0]].text,
+                                                              speakers_to_features[speaker]['conditioning_latents'],
+                                                              use_deterministic_seed=cfg.tts.seed)
+            store_utterance(batch_idxs[0], gen_start, gen=gen, cache_path=cache_paths.get(batch_idxs[0]),
+                            candidate_scores=candidate_scores)
+        else:
+            gens = tts_batch([data[idx].text for idx in batch_idxs],
+                             speakers_to_features[speaker]['conditioning_latents'],
+                             preset=cfg.tts.preset, use_deterministic_seed=cfg.tts.seed,
+                             num_autoregressive_samples=cfg.tts.num_autoregressive_samples)
+            for idx, gen in zip(batch_idxs, gens):
+                # completed utterances of a resumed batch are synthesized again only to keep the batch intact.
+                if idx in synth_idxs_set:
+                    store_utterance(idx, gen_start, gen=gen, cache_path=cache_paths.get(idx))
+
+    for idx in cached_idxs:
+        store_utterance(idx, datetime.now(), cache_path=cache_paths[idx])
+
 
+def run_read_job(db: Session, job: SynthesisJob, raw_text: str, on_progress: Callable[[int], None]):
+    check_for_repetitions = False
+    translation = job.translation
     speakers_to_features = dict()
     data: list[RawUtterance] = []
     for utter in split_on_raw_utterances(raw_text):
@@ -56,33 +358,36 @@ def read(title, lang, raw_text, request: gr.Request=None):
         if not db_speaker:
             raise Exception(f"No such speaker {utter.speaker}")
 
-        # load voice samples and conditioning latents.
+        # load conditioning latents.
         if db_speaker.name not in speakers_to_features:
-            spkr_data_root = db_speaker.get_speaker_data_root().parent
-            voice_samples, conditioning_latents = load_voices([db_speaker.name], [spkr_data_root])
             speakers_to_features[db_speaker.name] = {
                 'id': db_speaker.id,
-                'voice_samples': voice_samples,
-                'conditioning_latents': conditioning_latents}
+                'conditioning_latents': get_conditioning_latents(db_speaker)}
+            speakers_to_features[db_speaker.name]['latents_key'] = hash_latents(
+                speakers_to_features[db_speaker.name]['conditioning_latents'])
 
         for text in split_and_recombine_text(utter.text):
             data.append(RawUtterance(utter.timecode, db_speaker.name, text))
 
-    for idx, utter in enumerate(data):
-        gen_start = datetime.now()
-        gen = tts_model.tts_with_preset(utter.text,
-                                        voice_samples=speakers_to_features[utter.speaker]['voice_samples'],
-                                        conditioning_latents=speakers_to_features[utter.speaker]['conditioning_latents'],
-                                        preset=cfg.tts.preset, k=cfg.tts.candidates, use_deterministic_seed=cfg.tts.seed,
-                                        num_autoregressive_samples=cfg.tts.num_autoregressive_samples)
-        gen = gen.cpu().numpy().squeeze()
-
-        utterance_data = schemas.UtteranceCreate(text=utter.text, utterance_idx=idx,
-                                                 date_started=gen_start, timecode=utter.timecode)
-        utterance = crud.create_utterance(db, utterance_data, translation.id, speakers_to_features[utter.speaker]['id'])
-        sf.write(utterance.get_audio_path(), gen, cfg.tts.sample_rate)
-        crud.update_any_db_row(db, utterance, date_completed=datetime.now())
-        score = compute_and_store_score(db, utterance)
+    # utterance_idx is deterministic for the same text, so synthesis of an interrupted job continues from
+    # utterances without audio. Rows started but not completed are reused.
+    idx_to_utterance = {utterance.utterance_idx: utterance for utterance in translation.utterances}
+    for idx, utterance in idx_to_utterance.items():
+        if idx >= len(data) or utterance.text != data[idx].text:
+            raise Exception(f"Translation text changed since utterance {idx} was synthesized, can't resume")
+    pending_idxs = [idx for idx in range(len(data)) if not is_utterance_completed(idx_to_utterance.get(idx))]
+    crud.update_any_db_row(db, job, num_total=len(data), num_completed=len(data) - len(pending_idxs))
+
+    scorer = UtteranceScorer()
+    try:
+        synthesize_utterances(db, translation, data, pending_idxs, idx_to_utterance, speakers_to_features, scorer,
+                              on_progress)
+    except BaseException:
+        # an error of the scorer mustn't replace the one already propagating, e.g. JobCancelled.
+        scorer.close(raise_error=False)
+        raise
+    # scores of all utterances are stored before the translation is completed.
+    scorer.close()
 
     project = crud.update_any_db_row(db, translation, date_completed=datetime.now())
 
@@ -102,7 +407,8 @@ def read(title, lang, raw_text, request: gr.Request=None):
             wav = torch.from_numpy(wav).unsqueeze(0)
             new_res_wav = aligner.redact(wav, res)
             new_res_wav = new_res_wav.cpu().numpy().squeeze()
-            new_text_stt = stt_model.transcribe(new_res_wav)['text']
+            with stt_model_lock:
+                new_text_stt = stt_model.transcribe(new_res_wav)['text']
             new_similarity_score = compute_string_similarity(utter.text, new_text_stt)
             if new_similarity_score > stt_utterance.levenstein_similarity:
                 print(f'Yay! looks like repetition caught and corrected, for text {utter.text}'
@@ -114,39 +420,65 @@ def read(title, lang, raw_text, request: gr.Request=None):
                 crud.create_utterance_stt(db, utter_stt)
                 sf.write(utter.get_audio_path(), new_res_wav, sample_rate)
 
-    db.close()
-    return title
+
+def get_playground_dir(user: User, job_id: int) -> pathlib.Path:
+    playground_dir = user.get_user_data_root().joinpath('playground', f'job_{job_id}')
+    playground_dir.mkdir(parents=True, exist_ok=True)
+    return playground_dir
 
 
 def playground_read(text, speaker_name, user_email):
+    """Synthesis runs as an interactive job in the worker owning the tts model, candidates are read back from disk."""
     db: Session = SessionLocal()
     user = crud.get_user_by_email(db, user_email)
-    # support of multiple speakers
-    spkr_to_spkr_root = dict()
     for spkr in speaker_name.split('&'):
-        db_speaker = crud.get_speaker_by_name(db, spkr, user.id)
-        if not db_speaker:
+        if not crud.get_speaker_by_name(db, spkr, user.id):
             raise Exception(f"Speaker {spkr} doesn't exists. Add it first")
-        spkr_to_spkr_root[db_speaker.name] = db_speaker.get_speaker_data_root().parent
 
-    voice_samples, conditioning_latents = load_voices(list(spkr_to_spkr_root.keys()), list(spkr_to_spkr_root.values()))
-    gen = tts_model.tts_with_preset(text, voice_samples=voice_samples, conditioning_latents=conditioning_latents,
-                                    preset=cfg.tts.preset, k=cfg.tts.playground.candidates, use_deterministic_seed=None,
-                                    num_autoregressive_samples=cfg.tts.num_autoregressive_samples)
+    job = submit_job(db, 'playground', None, reread_priority, text=text, speaker_name=speaker_name,
+                     user_email=user_email)
+    wait_for_job(db, job)
+
+    playground_dir = get_playground_dir(user, job.id)
+    with open(playground_dir.joinpath('candidates.json')) as fd:
+        candidates = json.load(fd)
     db.close()
     outputs = []
-    for g in gen:
-        g = g.cpu().numpy().squeeze()
-        stt_res = stt_model.transcribe(g)
-        stt_text = stt_res['text']
-        similarity = compute_string_similarity(text, stt_text)
+    for i, (stt_text, similarity) in enumerate(candidates):
+        g, sample_rate = sf.read(playground_dir.joinpath(f'{i}.wav'), dtype='float32')
         outputs.append(stt_text)
         outputs.append(similarity)
-        outputs.append((cfg.tts.sample_rate, g))
+        outputs.append((sample_rate, g))
 
     return outputs
 
 
+def run_playground_job(db: Session, job: SynthesisJob, text: str, speaker_name: str, user_email: str,
+                       on_progress: Callable[[int], None]):
+    user = crud.get_user_by_email(db, user_email)
+    crud.update_any_db_row(db, job, num_total=cfg.tts.playground.candidates)
+    # support of multiple speakers, latents are averaged as tortoise load_voices does for latent voices.
+    speakers_latents = []
+    for spkr in speaker_name.split('&'):
+        db_speaker = crud.get_speaker_by_name(db, spkr, user.id)
+        speakers_latents.append(get_conditioning_latents(db_speaker))
+
+    conditioning_latents = tuple(sum(latents) / len(latents) for latents in zip(*speakers_latents))
+    gen = tts_model.tts_with_preset(text, voice_samples=None, conditioning_latents=conditioning_latents,
+                                    preset=cfg.tts.preset, k=cfg.tts.playground.candidates, use_deterministic_seed=None,
+                                    num_autoregressive_samples=cfg.tts.num_autoregressive_samples)
+    gens = [g.cpu().numpy().squeeze() for g in gen]
+    candidates = score_candidates(text, gens, cfg.tts.sample_rate)
+
+    playground_dir = get_playground_dir(user, job.id)
+    for i, g in enumerate(gens):
+        sf.write(playground_dir.joinpath(f'{i}.wav'), g, cfg.tts.sample_rate)
+    with open(playground_dir.joinpath('candidates.json'), 'w') as fd:
+        json.dump(candidates, fd)
+    for i in range(len(gens)):
+        on_progress(i)
+
+
 def load_translation(cross_project_name: str, lang: str, request: gr.Request):
     user_email = get_user_from_request(request)
     db = SessionLocal()
@@ -233,13 +565,30 @@ def reread(cross_project_name, lang, text, utterance_idx, speaker_name, request:
     if not utterance:
         raise Exception(f"Something went wrong, Utterance {utterance_idx} doesn't exists. "
                         f"Normally this shouldn't happen")
+    job = submit_job(db, 'reread', translation_db.id, reread_priority, text=text, utterance_idx=utterance_idx,
+                     speaker_name=speaker_name, lang=lang)
+    wait_for_job(db, job)
+
+    db.refresh(utterance)
+    gen, sample_rate = sf.read(utterance.get_audio_path(), dtype='float32')
+    score = get_or_compute_score(db, utterance)
+    db.close()
+    return (sample_rate, gen), speaker_name, score
+
+
+def run_reread_job(db: Session, job: SynthesisJob, text: str, utterance_idx: int, speaker_name: str, lang: str,
+                   on_progress: Callable[[int], None]):
+    translation_db = job.translation
+    new_speaker = crud.get_speaker_by_name(db, speaker_name, translation_db.cross_project_id)
+    utterance = crud.get_utterance(db, utterance_idx, translation_db.id)
+    crud.update_any_db_row(db, job, num_total=1)
+
     start_time = datetime.now()
-    voice_samples, conditioning_latents = load_voices([speaker_name], [new_speaker.get_speaker_data_root().parent])
-    # in favour of variation seed should be None
-    gen = tts_model.tts_with_preset(text, voice_samples=voice_samples, conditioning_latents=conditioning_latents,
-                                    preset=cfg.tts.preset, k=cfg.tts.candidates, use_deterministic_seed=None,
-                                    num_autoregressive_samples=cfg.tts.num_autoregressive_samples)
-    gen = gen.cpu().numpy().squeeze()
+    conditioning_latents = get_conditioning_latents(new_speaker)
+    language = 'en' if lang == 'EN-US' else None
+    # in favour of variation seed should be None, synthesis cache is bypassed for the same reason.
+    gen, candidate_scores = synthesize_best_candidate(text, conditioning_latents, use_deterministic_seed=None,
+                                                      language=language)
 
     sf.write(utterance.get_audio_path(), gen, cfg.tts.sample_rate)
     update_dict = {
@@ -249,9 +598,57 @@ def reread(cross_project_name, lang, text, utterance_idx, speaker_name, request:
         'date_completed': datetime.now()
     }
     utterance = crud.update_any_db_row(db, utterance, **update_dict)
-    score = compute_and_store_score(db, utterance, lang='en' if lang == 'EN-US' else None)
-    db.close()
-    return (cfg.tts.sample_rate, gen), speaker_name, score
+    if candidate_scores:
+        store_scores(db, utterance, candidate_scores)
+    else:
+        compute_and_store_score(db, utterance, lang=language)
+    on_progress(utterance_idx)
+
+
+def write_stems(utterances: list[tuple[pathlib.Path, int]], starts: list[int], stem_paths: dict[int, pathlib.Path],
+                sample_rate: int, idxs: list[int], total_frames: int, create: bool,
+                block_size: int = 1 << 16) -> dict[int, float]:
+    """Writes utterances of idxs at their start frames into per speaker stems, silence of other speakers in blocks.
+    Stems are either created or updated in place and truncated to total_frames.
+    Only one utterance is held in memory. Returns peaks of the written utterances.
+    """
+    open_kwargs = {'samplerate': sample_rate, 'channels': 1} if create else {}
+    stems = {speaker_id: sf.SoundFile(path, 'w' if create else 'r+', **open_kwargs)
+             for speaker_id, path in stem_paths.items()}
+    peaks = dict()
+    try:
+        for idx in idxs:
+            audio_path, speaker_id = utterances[idx]
+            utter_audio, utter_sample_rate = sf.read(audio_path, dtype='float32')
+            assert utter_audio.ndim == 1 and utter_sample_rate == sample_rate
+            peaks[idx] = float(np.abs(utter_audio).max(initial=0.0))
+            for stem_speaker_id, stem in stems.items():
+                stem.seek(starts[idx])
+                if stem_speaker_id == speaker_id:
+                    stem.write(utter_audio)
+                    continue
+                for start in range(0, len(utter_audio), block_size):
+                    stem.write(np.zeros(min(block_size, len(utter_audio) - start), dtype=np.float32))
+        for stem in stems.values():
+            if stem.frames > total_frames:
+                stem.truncate(total_frames)
+    finally:
+        for stem in stems.values():
+            stem.close()
+    return peaks
+
+
+def write_mix(utterances: list[tuple[pathlib.Path, int]], starts: list[int], mix_path: pathlib.Path,
+              sample_rate: int, scale: float, idxs: list[int], total_frames: int, create: bool):
+    """Utterances don't overlap, so the mix is their sequence scaled to the peak, written like write_stems."""
+    open_kwargs = {'samplerate': sample_rate, 'channels': 1} if create else {}
+    with sf.SoundFile(mix_path, 'w' if create else 'r+', **open_kwargs) as mix:
+        for idx in idxs:
+            utter_audio, _ = sf.read(utterances[idx][0], dtype='float32')
+            mix.seek(starts[idx])
+            mix.write(utter_audio * scale)
+        if mix.frames > total_frames:
+            mix.truncate(total_frames)
 
 
 def combine(cross_project_name, lang, request: gr.Request):
@@ -262,54 +659,78 @@ def combine(cross_project_name, lang, request: gr.Request):
     combined_dir = translation_db.utterances[0].get_audio_path().parent.joinpath('combined')
     combined_dir.mkdir(exist_ok=True)
 
-    unique_speakers = set([utter.speaker_id for utter in translation_db.utterances])
-    project_audio_tracks = defaultdict(list)
+    # utterances follow each other, so the timeline is known from file headers up front.
+    utterances = translation_db.utterances
+    entries = []
+    starts = []
     metadata = []
-    start_sec = 0
-    for utterance in translation_db.utterances:
-        utter_audio, sample_rate = sf.read(utterance.get_audio_path())
-
-        assert utter_audio.ndim == 1
-        n_sample = utter_audio.shape[0]
-        project_audio_tracks[utterance.speaker_id].extend(utter_audio)
-
-        silence_audio = np.zeros_like(utter_audio)
-        for other_spkr_id in (unique_speakers - {utterance.speaker_id}):
-            project_audio_tracks[other_spkr_id].extend(silence_audio)
-
-        end_sec = start_sec + n_sample / sample_rate
+    start_frame = 0
+    for utterance in utterances:
+        audio_path = utterance.get_audio_path()
+        entries.append({'utterance_idx': utterance.utterance_idx, 'speaker_id': utterance.speaker_id,
+                        'hash': compute_file_hash(audio_path), 'frames': sf.info(audio_path).frames})
+        end_frame = start_frame + entries[-1]['frames']
         metadata.append({
-            'start_sec': f'{start_sec:.3f}',
-            'end_sec': f'{end_sec:.3f}',
+            'start_sec': f'{start_frame / cfg.tts.sample_rate:.3f}',
+            'end_sec': f'{end_frame / cfg.tts.sample_rate:.3f}',
             'speaker_id': utterance.speaker_id,
             'speaker_name': utterance.speaker.name,
             'text': utterance.text,
         })
-        start_sec = end_sec
+        starts.append(start_frame)
+        start_frame = end_frame
+    total_frames = start_frame
 
     with open(combined_dir.joinpath('metadata.json'), 'w') as fd:
         json.dump(metadata, fd)
 
-    for k, v in project_audio_tracks.items():
-        sf.write(combined_dir.joinpath(f'combined_{k}.wav'), v, cfg.tts.sample_rate)
-
-    # quick mixing of all channels
-    all_channels = list(project_audio_tracks.values())
-    combined_waveform = np.array(all_channels[0])
-    for i in range(1, len(all_channels)):
-        combined_waveform += all_channels[i]
-    # normalize
-    combined_waveform /= np.abs(combined_waveform).max()
     combined_wav_path = combined_dir.joinpath(f'{translation_db.cross_project.title}.wav')
-    sf.write(combined_wav_path, combined_waveform, cfg.tts.sample_rate)
+    stem_paths = {speaker_id: combined_dir.joinpath(f'combined_{speaker_id}.wav')
+                  for speaker_id in set(utterance.speaker_id for utterance in utterances)}
+
+    # render manifest of the previous combine, only utterances changed since then are rendered.
+    manifest_path = combined_dir.joinpath('render_manifest.json')
+    manifest = None
+    if manifest_path.exists():
+        with open(manifest_path) as fd:
+            manifest = json.load(fd)
+        outputs_exist = combined_wav_path.exists() and all(path.exists() for path in stem_paths.values())
+        if (not outputs_exist or manifest['sample_rate'] != cfg.tts.sample_rate
+                or set(manifest['speaker_ids']) != set(stem_paths)):
+            manifest = None
+    idxs, create = plan_incremental_render(manifest['utterances'] if manifest else None, entries)
+
+    audio_files = [(utterance.get_audio_path(), utterance.speaker_id) for utterance in utterances]
+    new_peaks = write_stems(audio_files, starts, stem_paths, cfg.tts.sample_rate, idxs, total_frames, create)
+    for i, entry in enumerate(entries):
+        entry['peak'] = new_peaks[i] if i in new_peaks else manifest['utterances'][i]['peak']
+    peak = max((entry['peak'] for entry in entries), default=0.0)
+    if manifest is None or peak != manifest['peak']:
+        # normalization changed, whole mix is rescaled.
+        mix_idxs, mix_create = list(range(len(entries))), True
+    else:
+        mix_idxs, mix_create = idxs, create
+    scale = 1.0 / peak if peak > 0 else 1.0
+    write_mix(audio_files, starts, combined_wav_path, cfg.tts.sample_rate, scale, mix_idxs, total_frames, mix_create)
+
+    with open(manifest_path, 'w') as fd:
+        json.dump({'sample_rate': cfg.tts.sample_rate, 'speaker_ids': list(stem_paths), 'peak': peak,
+                   'total_frames': total_frames, 'utterances': entries}, fd)
 
-    res = convert_wav_to_mp3_ffmpeg(combined_wav_path, combined_wav_path.with_suffix('.mp3'))
+    # removed utterances are only a truncation of the render, nothing is written but outputs change as well.
+    is_changed = len(mix_idxs) > 0 or mix_create or total_frames != manifest.get('total_frames')
+    combined_mp3_path = combined_wav_path.with_suffix('.mp3')
+    if is_changed or not combined_mp3_path.exists():
+        res = convert_wav_to_mp3_ffmpeg(combined_wav_path, combined_mp3_path)
 
     db.close()
 
     src_media_path = translation_db.cross_project.get_media_path()
     mux_media_path = src_media_path.with_suffix('.output.mp4')
-    if media_has_video_steam(src_media_path):
+    if not is_changed and mux_media_path.exists():
+        # nothing to re-mux after an unchanged render
+        pass
+    elif media_has_video_steam(src_media_path):
         # sample rate = 1 - will return result in seconds, neat trick:)
         start_sec = timecode_to_timerange(translation_db.utterances[0].timecode, 1)[0]
         mux_video_audio(src_media_path, combined_wav_path, str(mux_media_path), start_sec)
@@ -339,40 +760,54 @@ def timecode_to_timerange(timecode: str, sample_rate: int) -> tuple[int, int]:
     return start_frame, end_frame
 
 
-def timecode_based_combine(utterances: list[Utterance]):
+def timecode_based_combine(utterances: list[Utterance], compress: bool = False, max_rate: float = 1.5) -> list[dict]:
     """
-    This method will only make sense if total duration of all utterances
-    is shorter than duration of reference video.
+    Places utterances at the source start of their timecode, utterances sharing a timecode follow each other.
+    With compress, utterances longer than the time till the next timecode are sped up to fit, up to max_rate.
+    Returns overlaps left on the timeline, they are also saved next to the combined audio.
 
     """
-    temp_utterances = []
-    cur_timecode = utterances[0].timecode
-    cur_group = []
+    sample_rate = cfg.tts.sample_rate
+    timeranges = dict()
+    groups: list[tuple[str, list[Utterance]]] = []
     for utter in utterances:
-        utter_audio, sample_rate = sf.read(utter.get_audio_path())
-
-        assert utter_audio.ndim == 1
-
-        if utter.timecode == cur_timecode:
-            cur_group.extend(list(utter_audio))
+        if utter.timecode not in timeranges:
+            timeranges[utter.timecode] = timecode_to_timerange(utter.timecode, sample_rate)
+        if groups and groups[-1][0] == utter.timecode:
+            groups[-1][1].append(utter)
         else:
-            time_range = timecode_to_timerange(cur_timecode, sample_rate)
-            temp_utterances.append((time_range, cur_group))
-            cur_timecode = utter.timecode
-            cur_group = list(utter_audio)
-
-    res = []
-    for item in temp_utterances:
-        time_range, utter_wav = item
-        s, e = time_range
-        # pad with silence
-        print(s, e, len(res))
-        if s > len(res):
-            silence_duration = len(res) - s
-            silence_seg = [0] * silence_duration
-            res.extend(silence_seg)
-        res.extend(utter_wav)
+            groups.append((utter.timecode, [utter]))
+
+    # layout needs only durations, audio is read once while placing.
+    starts = np.array([timeranges[timecode][0] for timecode, _ in groups], dtype=np.int64)
+    lengths = np.array([sum(sf.info(utter.get_audio_path()).frames for utter in group) for _, group in groups],
+                       dtype=np.int64)
+    order = np.argsort(starts, kind='stable')
+    starts, lengths = starts[order], lengths[order]
+    groups = [groups[i] for i in order]
+    rates, placed_lengths, overlaps = layout_timeline(starts, lengths, compress, max_rate)
+
+    timeline = np.zeros(int((starts + placed_lengths).max(initial=0)), dtype=np.float32)
+    for (_, group), start, rate in zip(groups, starts, rates):
+        group_audio = np.concatenate([sf.read(utter.get_audio_path(), dtype='float32')[0] for utter in group])
+        if rate > 1.0:
+            group_audio = time_compress(group_audio, rate)
+        timeline[start: start + len(group_audio)] += group_audio
+    # overlapping utterances are summed and might clip
+    peak = np.abs(timeline).max(initial=0.0)
+    if peak > 1.0:
+        timeline /= peak
+
+    overlaps_report = [{
+        'utterance_idx': group[0].utterance_idx,
+        'timecode': timecode,
+        'rate': round(float(rate), 3),
+        'overlap_sec': round(float(overlap) / sample_rate, 3),
+    } for (timecode, group), rate, overlap in zip(groups, rates, overlaps) if overlap > 0]
 
     combined_dir = utterances[0].get_audio_path().parent.joinpath('combined')
     combined_dir.mkdir(exist_ok=True)
-    sf.write(combined_dir.joinpath(f'timecode_combined.wav'), res, cfg.tts.sample_rate)
+    sf.write(combined_dir.joinpath(f'timecode_combined.wav'), timeline, sample_rate)
+    with open(combined_dir.joinpath('timecode_overlaps.json'), 'w') as fd:
+        json.dump(overlaps_report, fd)
+    return overlaps_report
@@ -0,0 +1,66 @@
+import json
+import time
+import traceback
+from datetime import datetime
+
+from sqlalchemy.orm import Session
+
+from config import cfg
+from db import crud
+from db.database import SessionLocal
+from db.models import SynthesisJob
+from editor_app import tts
+from editor_app.jobs import JobCancelled, fail_orphaned_jobs, update_job_progress
+
+
+def process_job(db: Session, job: SynthesisJob):
+    crud.update_any_db_row(db, job, status='running', date_started=datetime.now(), date_updated=datetime.now())
+    params = json.loads(job.params)
+
+    def on_progress(utterance_idx: int):
+        update_job_progress(db, job, utterance_idx)
+        # interactive jobs submitted meanwhile don't wait for the whole read to finish.
+        run_pending_jobs(db, min_priority=job.priority + 1)
+
+    try:
+        if job.kind == 'read':
+            tts.run_read_job(db, job, on_progress=on_progress, **params)
+        elif job.kind == 'reread':
+            tts.run_reread_job(db, job, on_progress=on_progress, **params)
+        elif job.kind == 'playground':
+            tts.run_playground_job(db, job, on_progress=on_progress, **params)
+        else:
+            raise Exception(f"Unknown job kind {job.kind}")
+        crud.update_any_db_row(db, job, status='completed', date_completed=datetime.now())
+    except JobCancelled:
+        crud.update_any_db_row(db, job, status='cancelled', date_completed=datetime.now())
+    except Exception as e:
+        traceback.print_exc()
+        db.rollback()
+        crud.update_any_db_row(db, job, status='failed', error=str(e), date_completed=datetime.now())
+
+
+def run_pending_jobs(db: Session, min_priority: int = None) -> int:
+    num_jobs = 0
+    while job := crud.get_next_synthesis_job(db, min_priority):
+        process_job(db, job)
+        num_jobs += 1
+    return num_jobs
+
+
+def run_worker():
+    """Owns the tts model and runs queued synthesis jobs, most prioritized first."""
+    if tts.tts_model is None:
+        tts.load_tts_models()
+    db: Session = SessionLocal()
+    while True:
+        if not run_pending_jobs(db):
+            time.sleep(cfg.tts.jobs.poll_interval_sec)
+
+
+if __name__ == '__main__':
+    # in-app worker threads fail orphaned jobs in ensure_worker, before the app serves any request.
+    worker_db: Session = SessionLocal()
+    fail_orphaned_jobs(worker_db)
+    worker_db.close()
+    run_worker()
@@ -1,18 +1,29 @@
+import hashlib
+import json
 import os
 import shutil
 import subprocess
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from urllib.parse import urlparse
 
 import ffmpeg
+import numpy as np
 import requests
+import soundfile as sf
 from pytube import YouTube
 
-from config import cfg
+from config import cfg, data_root
 from string_utils import get_random_string
 
 ffmpeg_path = shutil.which("ffmpeg")
 demucs_path = shutil.which("demucs")
+demucs_cache_root = data_root.joinpath("cache", "demucs")
+probe_cache = OrderedDict()
+probe_cache_lock = threading.Lock()
 
 audio_extensions = [
     '.mp3',
@@ -37,28 +48,124 @@ video_extensions = [
 
 media_extensions = audio_extensions + video_extensions
 
+# video codecs which can be stream copied into mp4 container
+mp4_copy_video_codecs = {'h264', 'hevc', 'mpeg4', 'av1', 'vp9'}
+
+
+def probe_media(media_path: Path | str) -> dict:
+    """ffmpeg.probe with caching, keyed by path, modification time and size of the media.
+    The latest cfg.mux.probe_cache_size probes are kept in memory, probes of media under data_root are also
+    persisted in a sidecar json next to the media, {media_name}.probe.json.
+    """
+    media_path = Path(media_path)
+    stat = media_path.stat()
+    resolved_path = media_path.resolve()
+    key = (str(resolved_path), stat.st_mtime_ns, stat.st_size)
+    with probe_cache_lock:
+        if key in probe_cache:
+            probe_cache.move_to_end(key)
+            return probe_cache[key]
+
+    sidecar_path = media_path.with_name(f"{media_path.name}.probe.json")
+    # no sidecars next to repo assets or other media outside of user data.
+    use_sidecar = resolved_path.is_relative_to(data_root.resolve())
+    probe = None
+    if use_sidecar and sidecar_path.exists():
+        try:
+            with open(sidecar_path) as f:
+                sidecar = json.load(f)
+            if (sidecar['mtime_ns'], sidecar['size']) == (stat.st_mtime_ns, stat.st_size):
+                probe = sidecar['probe']
+        except (ValueError, KeyError):
+            pass
+    if probe is None:
+        probe = ffmpeg.probe(str(media_path))
+        if use_sidecar:
+            try:
+                with open(sidecar_path, 'w') as f:
+                    json.dump({'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'probe': probe}, f)
+            except OSError:
+                # media dir might be read only, in-memory cache still works
+                pass
+
+    with probe_cache_lock:
+        probe_cache[key] = probe
+        # every rewrite of a media file adds a new key, old ones are evicted.
+        if len(probe_cache) > cfg.mux.probe_cache_size:
+            probe_cache.popitem(last=False)
+    return probe
+
 
 def media_has_video_steam(media_path: Path) -> bool:
-    probe = ffmpeg.probe(media_path)
+    probe = probe_media(media_path)
     video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
     return video_stream is not None
 
 
 def get_stream_duration(media_path, stream_type='audio'):
-    probe = ffmpeg.probe(media_path)
+    probe = probe_media(media_path)
     stream = next((stream for stream in probe['streams'] if stream['codec_type'] == stream_type), None)
     return round(float(stream['duration'])) if stream is not None else None
 
 
-def mux_video_audio(video_path: Path, audio_path: Path, output_path: str, video_offset_sec: int = 0):
+def get_media_duration(media_path: Path) -> float:
+    probe = probe_media(media_path)
+    return float(probe['format']['duration'])
+
+
+def find_nearest_keyframe(video_path: Path, offset_sec: float, window_sec: float = 10) -> float | None:
+    """Returns time of the keyframe nearest to offset_sec, both relative to the start of the video stream,
+    the way input seeking with ss interprets them."""
+    video_stream = next(stream for stream in probe_media(video_path)['streams'] if stream['codec_type'] == 'video')
+    start_sec = float(video_stream.get('start_time', 0))
+    # frame timestamps and read intervals are absolute
+    read_start_sec = start_sec + max(offset_sec - window_sec, 0)
+    probe = ffmpeg.probe(str(video_path), select_streams='v:0', skip_frame='nokey', show_entries='frame=pts_time',
+                         read_intervals=f'{read_start_sec}%{start_sec + offset_sec + window_sec}')
+    keyframes_sec = [float(frame['pts_time']) - start_sec for frame in probe.get('frames', []) if 'pts_time' in frame]
+    if len(keyframes_sec) == 0:
+        return None
+    return min(keyframes_sec, key=lambda x: abs(x - offset_sec))
+
+
+def mux_video_audio(video_path: Path, audio_path: Path, output_path: str, video_offset_sec: int = 0,
+                    stream_copy: bool | None = None):
     """Maps the video stream from one file and the audio stream from another file
        and saves the output to a new file using ffmpeg.
+       With stream_copy, the video stream is copied without re-encoding when its codec fits mp4,
+       offset is snapped to the nearest keyframe within cfg.mux.max_keyframe_shift_sec
+       and audio is delayed or trimmed by the same shift, so it stays in sync with the video.
+       Otherwise, or if copying fails, video is re-encoded.
     Raises:
         ValueError: If the video and audio files have incompatible codecs.
 
     """
-    # Use ffmpeg to get the streams from the video and audio files
+    if stream_copy is None:
+        stream_copy = cfg.mux.stream_copy
     audio_duration = get_stream_duration(audio_path)
+
+    if stream_copy:
+        video_stream = next(stream for stream in probe_media(video_path)['streams'] if stream['codec_type'] == 'video')
+        if video_stream['codec_name'] in mp4_copy_video_codecs:
+            keyframe_sec = find_nearest_keyframe(video_path, video_offset_sec) if video_offset_sec else 0
+            if keyframe_sec is not None and abs(keyframe_sec - video_offset_sec) <= cfg.mux.max_keyframe_shift_sec:
+                # video starts this much earlier than the audio was made for, negative if it starts later.
+                shift_sec = video_offset_sec - keyframe_sec
+                video = ffmpeg.input(video_path, ss=keyframe_sec, t=audio_duration+shift_sec+cfg.demo.extra_dur_sec)
+                audio = ffmpeg.input(audio_path).audio
+                if shift_sec > 0:
+                    audio = audio.filter('adelay', delays=int(round(shift_sec * 1000)), all=1)
+                elif shift_sec < 0:
+                    audio = audio.filter('atrim', start=-shift_sec).filter('asetpts', 'PTS-STARTPTS')
+                output = ffmpeg.output(video.video, audio, output_path, vcodec='copy', acodec='aac')
+                try:
+                    ffmpeg.run(output.overwrite_output())
+                    return
+                except ffmpeg.Error:
+                    # fall back to re-encoding
+                    pass
+
+    # Use ffmpeg to get the streams from the video and audio files
     video = ffmpeg.input(video_path, ss=video_offset_sec, t=audio_duration+cfg.demo.extra_dur_sec)
     audio = ffmpeg.input(audio_path)
 
@@ -76,9 +183,12 @@ def mux_video_audio(video_path: Path, audio_path: Path, output_path: str, video_
             raise e
 
 
-def extract_audio(media_path: Path, raw_audio_path: Path):
-    in_media = ffmpeg.input(media_path)
-    in_media.audio.output(str(raw_audio_path), **{'ac': 1}).run()
+def extract_audio(media_path: Path, raw_audio_path: Path, start_sec: float = 0, duration_sec: float | None = None):
+    input_kwargs = {'ss': start_sec} if start_sec else {}
+    if duration_sec is not None:
+        input_kwargs['t'] = duration_sec
+    in_media = ffmpeg.input(media_path, **input_kwargs)
+    in_media.audio.output(str(raw_audio_path), **{'ac': 1}).overwrite_output().run()
 
 
 def resample_audio(audio_path: Path, resample_audio_path: Path, sample_rate: int):
@@ -86,6 +196,54 @@ def resample_audio(audio_path: Path, resample_audio_path: Path, sample_rate: int
     ffmpeg.output(audio, str(resample_audio_path), **{'ar': sample_rate}).run()
 
 
+def resample_audio_variants(audio_path: Path, sample_rate_to_path: dict[int, Path]):
+    """Resamples audio to several sample rates in a single decoding pass of the source.
+    Decoded stream is split with asplit and every branch gets its own aresample.
+    """
+    audio = ffmpeg.input(str(audio_path)).audio
+    branches = audio.filter_multi_output('asplit', len(sample_rate_to_path))
+    outputs = []
+    for idx, (sample_rate, out_path) in enumerate(sample_rate_to_path.items()):
+        outputs.append(branches[idx].filter('aresample', sample_rate).output(str(out_path), ar=sample_rate))
+    ffmpeg.merge_outputs(*outputs).overwrite_output().run()
+
+
+def decode_audio(in_path: Path, sample_rate: int, start_sec: float = 0, duration_sec: float | None = None,
+                 write_path: Path | None = None, chunk_size: int = 1 << 20) -> np.ndarray:
+    """Decodes audio to a mono float32 numpy array without intermediate files.
+    Raw f32le pcm is streamed from ffmpeg stdout straight into a buffer preallocated from the probed duration.
+    If write_path is provided, the same decoded audio is also written there in the same pass.
+    """
+    input_kwargs = {'ss': start_sec} if start_sec else {}
+    if duration_sec is not None:
+        input_kwargs['t'] = duration_sec
+    audio = ffmpeg.input(str(in_path), **input_kwargs).audio
+    pcm_kwargs = {'format': 'f32le', 'acodec': 'pcm_f32le', 'ac': 1, 'ar': sample_rate}
+    if write_path is None:
+        stream = audio.output('pipe:', **pcm_kwargs)
+    else:
+        branches = audio.filter_multi_output('asplit', 2)
+        stream = ffmpeg.merge_outputs(branches[0].output('pipe:', **pcm_kwargs),
+                                      branches[1].output(str(write_path), ac=1, ar=sample_rate))
+    process = stream.global_args('-hide_banner', '-loglevel', 'error').overwrite_output().run_async(pipe_stdout=True)
+
+    if duration_sec is None:
+        duration_sec = get_media_duration(in_path) - start_sec
+    # one extra second for rounding of the probed duration
+    buffer = np.empty(int((duration_sec + 1) * sample_rate), dtype=np.float32)
+    num_bytes = 0
+    while True:
+        if num_bytes + chunk_size > buffer.nbytes:
+            buffer = np.resize(buffer, 2 * len(buffer) + chunk_size // buffer.itemsize)
+        n_read = process.stdout.readinto(memoryview(buffer).cast('B')[num_bytes: num_bytes + chunk_size])
+        if not n_read:
+            break
+        num_bytes += n_read
+    if process.wait() != 0:
+        raise ffmpeg.Error('ffmpeg', None, None)
+    return buffer[:num_bytes // buffer.itemsize]
+
+
 def get_youtube_embed_code(youtube_link) -> str:
 
     yt = YouTube(youtube_link)
@@ -93,14 +251,134 @@ def get_youtube_embed_code(youtube_link) -> str:
     return iframe_code
 
 
-def demucs_audio(audio_path: Path):
+def compute_file_hash(file_path: Path, chunk_size: int = 1 << 20) -> str:
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def link_or_copy(src_path: Path, dst_path: Path):
+    dst_path.parent.mkdir(parents=True, exist_ok=True)
+    dst_path.unlink(missing_ok=True)
+    try:
+        os.link(src_path, dst_path)
+    except OSError:
+        # hardlinks don't work across file systems
+        shutil.copy(src_path, dst_path)
+
+
+def run_demucs(audio_path: Path, out_dir: Path, model_name: str, stem: str, env: dict | None = None):
     command = [
         f"{demucs_path}",
-        "--two-stems", "vocals",
-        "--out", f"{audio_path.parent}",
+        "-n", model_name,
+        "--two-stems", stem,
+        "--out", f"{out_dir}",
         "--filename", "{track}.{stem}.{ext}",
         f"{audio_path}"]
-    res = subprocess.run(command, check=True)
+    return subprocess.run(command, check=True, env=env)
+
+
+def overlap_add_chunks(chunk_paths: list[Path], chunk_starts_sec: list[float], out_path: Path):
+    """Joins overlapping chunks with a linear crossfade over their overlap.
+    Chunks are read and written one at a time, so memory is proportional to a single chunk.
+    """
+    info = sf.info(chunk_paths[0])
+    sample_rate = info.samplerate
+    with sf.SoundFile(out_path, 'w', samplerate=sample_rate, channels=info.channels, subtype=info.subtype) as out:
+        # end of previous chunk is kept until it's blended with the beginning of the next one.
+        tail, tail_end = None, 0
+        for chunk_idx, (chunk_path, start_sec) in enumerate(zip(chunk_paths, chunk_starts_sec)):
+            chunk, _ = sf.read(chunk_path, dtype='float32', always_2d=True)
+            start = int(round(start_sec * sample_rate))
+            if tail is not None:
+                overlap = min(max(tail_end - start, 0), len(tail), len(chunk))
+                out.write(tail[:len(tail) - overlap])
+                fade_in = np.linspace(0, 1, overlap, dtype=np.float32)[:, None]
+                out.write(tail[len(tail) - overlap:] * (1 - fade_in) + chunk[:overlap] * fade_in)
+                chunk = chunk[overlap:]
+                start += overlap
+            if chunk_idx + 1 < len(chunk_starts_sec):
+                next_start = int(round(chunk_starts_sec[chunk_idx + 1] * sample_rate))
+                split = min(max(next_start - start, 0), len(chunk))
+                out.write(chunk[:split])
+                tail, tail_end = chunk[split:], start + len(chunk)
+            else:
+                out.write(chunk)
+
+
+def demucs_audio_chunked(audio_path: Path, vocals_path: Path, model_name: str, stem: str):
+    """Splits audio into overlapping chunks, separates them with a pool of demucs processes,
+    one per cfg.demucs.num_workers or per cpu core, and joins separated chunks with overlap-add.
+    """
+    info = sf.info(audio_path)
+    chunk_len = int(cfg.demucs.chunk_sec * info.samplerate)
+    overlap_len = int(cfg.demucs.overlap_sec * info.samplerate)
+    if not 0 <= overlap_len < chunk_len:
+        raise ValueError(f"Chunk of {chunk_len} samples can't overlap by {overlap_len} samples")
+    chunk_starts = list(range(0, max(info.frames - overlap_len, 1), chunk_len - overlap_len))
+
+    num_cpus = os.cpu_count() or 1
+    num_workers = min(cfg.demucs.num_workers or num_cpus, len(chunk_starts))
+    # split cores between workers instead of every demucs process using all of them.
+    env = {**os.environ, 'OMP_NUM_THREADS': str(max(1, num_cpus // num_workers))}
+
+    with tempfile.TemporaryDirectory(dir=audio_path.parent) as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        chunk_paths = []
+        for chunk_idx, start in enumerate(chunk_starts):
+            chunk_path = tmp_dir.joinpath(f"chunk_{chunk_idx:04}.wav")
+            chunk, _ = sf.read(audio_path, start=start, stop=start + chunk_len, dtype='float32', always_2d=True)
+            sf.write(chunk_path, chunk, info.samplerate)
+            chunk_paths.append(chunk_path)
+
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            # every task is a separate demucs process, threads only wait for them.
+            list(pool.map(lambda x: run_demucs(x, tmp_dir, model_name, stem, env), chunk_paths))
+
+        stem_paths = [tmp_dir.joinpath(model_name, f"{path.stem}.{stem}.wav") for path in chunk_paths]
+        vocals_path.parent.mkdir(parents=True, exist_ok=True)
+        overlap_add_chunks(stem_paths, [start / info.samplerate for start in chunk_starts], vocals_path)
+
+
+def demucs_audio(audio_path: Path):
+    """Separates vocals with demucs, output is written to {audio_path.parent}/{model_name}/{track}.vocals.wav
+    Audio longer than cfg.demucs.chunk_sec is separated in overlapping chunks by a pool of demucs processes.
+    Separated vocals are cached by content of the input audio and separation options,
+    so resubmitting the same media skips separation and hardlinks cached vocals instead.
+    """
+    if cfg.demucs.chunk_sec > 0 and not 0 <= cfg.demucs.overlap_sec < cfg.demucs.chunk_sec:
+        raise ValueError(f"demucs.overlap_sec must be in [0, demucs.chunk_sec), "
+                         f"got {cfg.demucs.overlap_sec} with chunk_sec {cfg.demucs.chunk_sec}")
+    if cfg.demucs.num_workers < 0:
+        raise ValueError(f"demucs.num_workers must be >= 0, got {cfg.demucs.num_workers}")
+    model_name = cfg.demucs.model_name
+    stem = "vocals"
+    vocals_path = audio_path.parent.joinpath(model_name, f"{audio_path.stem}.{stem}.wav")
+    is_chunked = cfg.demucs.chunk_sec > 0 and sf.info(audio_path).duration > cfg.demucs.chunk_sec
+
+    if cfg.demucs.cache:
+        cache_key = f"{compute_file_hash(audio_path)}.{model_name}.two-stems-{stem}"
+        if is_chunked:
+            cache_key += f".chunked-{cfg.demucs.chunk_sec}-{cfg.demucs.overlap_sec}"
+        cached_vocals_path = demucs_cache_root.joinpath(f"{cache_key}.{stem}.wav")
+        if cached_vocals_path.exists():
+            link_or_copy(cached_vocals_path, vocals_path)
+            return
+
+    # vocals of a previous run might be a hardlink to a cache entry, separation must not write through it.
+    vocals_path.unlink(missing_ok=True)
+    if is_chunked:
+        res = demucs_audio_chunked(audio_path, vocals_path, model_name, stem)
+    else:
+        res = run_demucs(audio_path, audio_path.parent, model_name, stem)
+
+    if cfg.demucs.cache:
+        # link under a temporary name first, so concurrent readers never see a partial file.
+        tmp_path = cached_vocals_path.with_suffix(f".{get_random_string()}.tmp")
+        link_or_copy(vocals_path, tmp_path)
+        os.replace(tmp_path, cached_vocals_path)
     return res
 
 
@@ -0,0 +1,100 @@
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+
+import numpy as np
+import soundfile as sf
+
+from utils import AudioWindowReader, SpeechTimeline, detect_speech_regions, crop_speech_regions, merge_close_regions, \
+    plan_incremental_render, layout_timeline, time_compress
+
+
+class Test(TestCase):
+    def test_merge_close_regions(self):
+        regions = np.array([[0.0, 1.0], [1.5, 2.0], [4.0, 5.0], [4.5, 6.0]])
+        res = merge_close_regions(regions, 1.0)
+        self.assertTrue(np.allclose(res, [[0.0, 2.0], [4.0, 6.0]]))
+
+    def test_detect_speech_regions(self):
+        sample_rate = 16_000
+        rng = np.random.default_rng(0)
+        wav = np.zeros(sample_rate * 20, dtype=np.float32)
+        wav[sample_rate * 2: sample_rate * 5] = 0.1 * rng.standard_normal(sample_rate * 3)
+        wav[sample_rate * 12: sample_rate * 15] = 0.1 * rng.standard_normal(sample_rate * 3)
+        # too short to be speech
+        wav[sample_rate * 18: sample_rate * 18 + 800] = 0.1
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            wav_path = Path(tmp_dir).joinpath('input.wav')
+            speech_path = Path(tmp_dir).joinpath('input.speech.wav')
+            sf.write(wav_path, wav, sample_rate)
+
+            audio = AudioWindowReader(wav_path, streaming=True)
+            regions = detect_speech_regions(audio, pad_sec=0.2)
+            self.assertEqual(len(regions), 2)
+            self.assertTrue(np.allclose(regions, [[1.8, 5.2], [11.8, 15.2]], atol=0.05))
+
+            speech_duration = (regions[:, 1] - regions[:, 0]).sum()
+            speech_audio = crop_speech_regions(audio, regions, speech_path)
+            self.assertAlmostEqual(sf.info(speech_path).duration, speech_duration, places=2)
+
+            in_memory_audio = AudioWindowReader.from_waveform(wav, sample_rate)
+            self.assertTrue(np.allclose(detect_speech_regions(in_memory_audio, pad_sec=0.2), regions))
+            in_memory_speech_audio = crop_speech_regions(in_memory_audio, regions, speech_path)
+            self.assertEqual(in_memory_speech_audio.num_frames, speech_audio.num_frames)
+
+    def test_speech_timeline(self):
+        timeline = SpeechTimeline(np.array([[2.0, 5.0], [12.0, 15.0]]), offset_sec=100)
+        self.assertAlmostEqual(timeline.to_source(0.0), 102.0)
+        self.assertAlmostEqual(timeline.to_source(3.0), 112.0)
+        self.assertAlmostEqual(timeline.to_source(3.0, is_end=True), 105.0)
+        self.assertAlmostEqual(timeline.to_source(4.0), 113.0)
+
+    def test_speech_timeline_split(self):
+        timeline = SpeechTimeline(np.array([[0.0, 10.0], [610.0, 620.0]]))
+        self.assertEqual(timeline.split(2.0, 6.0), [(2.0, 6.0)])
+        # segment crossing the seam between regions doesn't swallow the removed 10 minutes in between
+        parts = timeline.split(8.0, 12.0)
+        self.assertEqual(parts, [(8.0, 10.0), (10.0, 12.0)])
+        src_parts = [(timeline.to_source(start), timeline.to_source(end, is_end=True)) for start, end in parts]
+        self.assertEqual(src_parts, [(8.0, 10.0), (610.0, 612.0)])
+
+    def test_plan_incremental_render(self):
+        entries = [{'hash': f'h{i}', 'speaker_id': i % 2, 'frames': 100} for i in range(5)]
+        self.assertEqual(plan_incremental_render(None, entries), ([0, 1, 2, 3, 4], True))
+        self.assertEqual(plan_incremental_render(entries, entries), ([], False))
+
+        patched = [dict(entry) for entry in entries]
+        patched[3]['hash'] = 'new'
+        self.assertEqual(plan_incremental_render(entries, patched), ([3], False))
+
+        patched[1]['frames'] = 120
+        self.assertEqual(plan_incremental_render(entries, patched), ([1, 2, 3, 4], False))
+        self.assertEqual(plan_incremental_render(entries, entries[:3]), ([], False))
+        self.assertEqual(plan_incremental_render(entries, entries + entries[:1]), ([5], False))
+
+        patched[0]['frames'] = 120
+        self.assertEqual(plan_incremental_render(entries, patched), ([0, 1, 2, 3, 4], True))
+
+    def test_layout_timeline(self):
+        starts = np.array([0, 100, 300])
+        lengths = np.array([150, 100, 50])
+        rates, placed_lengths, overlaps = layout_timeline(starts, lengths)
+        self.assertTrue(np.allclose(rates, 1.0))
+        self.assertEqual(overlaps.tolist(), [50, 0, 0])
+
+        rates, placed_lengths, overlaps = layout_timeline(starts, lengths, compress=True, max_rate=1.2)
+        self.assertAlmostEqual(rates[0], 1.2)
+        self.assertEqual(placed_lengths.tolist(), [125, 100, 50])
+        self.assertEqual(overlaps.tolist(), [25, 0, 0])
+
+    def test_time_compress(self):
+        sample_rate = 24_000
+        t = np.arange(sample_rate) / sample_rate
+        wav = np.sin(2 * np.pi * 200 * t).astype(np.float32)
+        res = time_compress(wav, 1.25)
+        self.assertEqual(len(res), int(len(wav) / 1.25))
+        # pitch is kept
+        spectrum = np.abs(np.fft.rfft(res))
+        peak_hz = np.argmax(spectrum) * sample_rate / len(res)
+        self.assertAlmostEqual(peak_hz, 200, delta=5)
@@ -0,0 +1,61 @@
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import patch
+
+import numpy as np
+import soundfile as sf
+
+from media_utils import decode_audio, overlap_add_chunks
+
+
+class Test(TestCase):
+    def test_overlap_add_chunks(self):
+        sample_rate = 1000
+        chunk_len, overlap_len = 3000, 500
+        rng = np.random.default_rng(0)
+        audio = rng.uniform(-0.5, 0.5, (10_000, 2)).astype(np.float32)
+        chunk_starts = list(range(0, len(audio) - overlap_len, chunk_len - overlap_len))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_dir = Path(tmp_dir)
+            chunk_paths = []
+            for chunk_idx, start in enumerate(chunk_starts):
+                chunk_path = tmp_dir.joinpath(f"chunk_{chunk_idx}.wav")
+                sf.write(chunk_path, audio[start:start + chunk_len], sample_rate, subtype='FLOAT')
+                chunk_paths.append(chunk_path)
+            out_path = tmp_dir.joinpath("out.wav")
+            overlap_add_chunks(chunk_paths, [start / sample_rate for start in chunk_starts], out_path)
+            res, res_sample_rate = sf.read(out_path, dtype='float32', always_2d=True)
+        self.assertEqual(len(chunk_paths), 4)
+        self.assertEqual(res_sample_rate, sample_rate)
+        self.assertEqual(res.shape, audio.shape)
+        # crossfade of identical overlaps gives back the original signal
+        self.assertTrue(np.allclose(res, audio, atol=1e-6))
+
+    def test_decode_audio(self):
+        sample_rate = 16_000
+        rng = np.random.default_rng(0)
+        audio = rng.uniform(-0.5, 0.5, 3 * sample_rate).astype(np.float32)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_dir = Path(tmp_dir)
+            wav_path = tmp_dir.joinpath("audio.wav")
+            sf.write(wav_path, audio, sample_rate, subtype='FLOAT')
+
+            # buffer preallocated from the probed duration is cut to the exact decoded length
+            res = decode_audio(wav_path, sample_rate, chunk_size=4096)
+            self.assertEqual(res.shape, audio.shape)
+            self.assertTrue(np.allclose(res, audio, atol=1e-6))
+
+            # underestimated duration makes the buffer grow while reading
+            with patch('media_utils.get_media_duration', return_value=0.1):
+                res = decode_audio(wav_path, sample_rate, chunk_size=4096)
+            self.assertEqual(res.shape, audio.shape)
+            self.assertTrue(np.allclose(res, audio, atol=1e-6))
+
+            write_path = tmp_dir.joinpath("written.wav")
+            res = decode_audio(wav_path, sample_rate, write_path=write_path)
+            written, written_sample_rate = sf.read(write_path, dtype='float32')
+            self.assertEqual(written_sample_rate, sample_rate)
+            self.assertEqual(written.shape, res.shape)
+            # written wav is 16 bit pcm
+            self.assertTrue(np.allclose(written, res, atol=1e-3))
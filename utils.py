@@ -1,9 +1,12 @@
+import queue
 import re
+import threading
 from collections import Counter
-from typing import Optional
+from typing import Callable, Iterable, Iterator, Optional
 from pathlib import Path
 
 import numpy as np
+import soundfile as sf
 import torch
 import gradio as gr
 import Levenshtein
@@ -153,7 +156,6 @@ def find_single_repetition(stt_str: str, tts_str: str) -> Optional[str]:
 def gradio_read_audio_data(audio_data: tuple[int, np.ndarray] | str | Path) -> (torch.Tensor, int):
     dtype = torch.float32
     if isinstance(audio_data, Path | str):
-        import soundfile as sf
         waveform, sample_rate = sf.read(audio_data, dtype=str(dtype).split('.')[-1])
         if len(waveform.shape) == 2:
             waveform = waveform[:, 0]
@@ -162,6 +164,232 @@ def gradio_read_audio_data(audio_data: tuple[int, np.ndarray] | str | Path) -> (
     return torch.from_numpy(waveform).to(dtype), sample_rate
 
 
+class AudioWindowReader:
+    """Reads windows of a wav file on demand.
+    In streaming mode only the requested window is read from disk with soundfile block reads,
+    so memory stays proportional to a single segment regardless of the file duration,
+    except for diarization, see diarization_input.
+    Otherwise the whole file is loaded once and windows are sliced from memory,
+    from_waveform wraps audio that is already in memory.
+    """
+
+    def __init__(self, path: Path | str, streaming: bool = True):
+        self.path = path
+        self.streaming = streaming
+        info = sf.info(path)
+        self.sample_rate = info.samplerate
+        self.num_frames = info.frames
+        self.waveform = None
+        if not streaming:
+            self.waveform = self.read(0, self.num_frames)
+
+    @classmethod
+    def from_waveform(cls, waveform: np.ndarray | torch.Tensor, sample_rate: int) -> 'AudioWindowReader':
+        reader = cls.__new__(cls)
+        reader.path = None
+        reader.streaming = False
+        reader.sample_rate = sample_rate
+        reader.num_frames = len(waveform)
+        reader.waveform = torch.as_tensor(waveform, dtype=torch.float32)
+        return reader
+
+    @property
+    def duration(self) -> float:
+        return self.num_frames / self.sample_rate
+
+    def read(self, start_frame: int, end_frame: int) -> torch.Tensor:
+        start_frame = max(0, start_frame)
+        end_frame = min(end_frame, self.num_frames)
+        if self.waveform is not None:
+            return self.waveform[start_frame: end_frame]
+        waveform, _ = sf.read(self.path, start=start_frame, stop=end_frame, dtype='float32', always_2d=True)
+        return torch.from_numpy(np.ascontiguousarray(waveform[:, 0]))
+
+    def crop(self, start_sec: float, end_sec: float) -> torch.Tensor:
+        return self.read(int(start_sec * self.sample_rate), int(end_sec * self.sample_rate))
+
+    def diarization_input(self) -> dict:
+        # pyannote inference loads the whole file before sliding its window over it, so diarization still holds
+        # the full track in memory, for the duration of diarization only. Passing the path avoids a second copy
+        # held by this reader. Diarization isn't windowed, as speakers are clustered over the whole file.
+        if self.streaming:
+            return {'audio': str(self.path)}
+        return {'waveform': self.read(0, self.num_frames).unsqueeze(0), 'sample_rate': self.sample_rate}
+
+
+def merge_close_regions(regions: np.ndarray, min_gap: float) -> np.ndarray:
+    """Merges sorted [start, end] regions separated by less than min_gap, overlapping regions are merged as well."""
+    if len(regions) < 2:
+        return regions
+    is_new = regions[1:, 0] - regions[:-1, 1] >= min_gap
+    starts = np.concatenate((regions[:1, 0], regions[1:, 0][is_new]))
+    ends = np.concatenate((regions[:-1, 1][is_new], regions[-1:, 1]))
+    return np.stack([starts, ends], axis=1)
+
+
+def detect_speech_regions(audio: AudioWindowReader, threshold_db: float = -45.0, frame_sec: float = 0.03,
+                          min_silence_sec: float = 1.0, min_speech_sec: float = 0.3, pad_sec: float = 0.2) -> np.ndarray:
+    """Energy based speech activity detection, meant to run on demucs vocals where music is already suppressed.
+    Audio is read block by block, so memory stays flat for streaming readers regardless of duration.
+    Returns (N, 2) array of [start_sec, end_sec] speech regions.
+    """
+    frame_len = max(1, int(frame_sec * audio.sample_rate))
+    frame_sec = frame_len / audio.sample_rate
+    block_len = frame_len * 1000
+
+    energies_db = []
+    for block_start in range(0, audio.num_frames, block_len):
+        block = audio.read(block_start, block_start + block_len).numpy()
+        num_frames = int(np.ceil(len(block) / frame_len))
+        frames = np.pad(block, (0, num_frames * frame_len - len(block))).reshape(num_frames, frame_len)
+        energies_db.append(10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-10))
+    if len(energies_db) == 0:
+        return np.zeros((0, 2))
+
+    is_speech = np.concatenate(energies_db) > threshold_db
+    edges = np.diff(np.concatenate(([0], is_speech.view(np.int8), [0])))
+    regions = np.stack([np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)], axis=1) * frame_sec
+
+    regions = merge_close_regions(regions, min_silence_sec)
+    regions = regions[regions[:, 1] - regions[:, 0] >= min_speech_sec]
+    regions[:, 0] = np.maximum(regions[:, 0] - pad_sec, 0)
+    regions[:, 1] = np.minimum(regions[:, 1] + pad_sec, audio.duration)
+    return merge_close_regions(regions, 0)
+
+
+def crop_speech_regions(audio: AudioWindowReader, regions: np.ndarray, dst_path: Path | str) -> AudioWindowReader:
+    """Concatenates regions of audio. Streaming readers are written to dst_path one region at a time
+    and read back on demand, in-memory readers are concatenated in memory.
+    """
+    frame_ranges = np.round(regions * audio.sample_rate).astype(np.int64)
+    if not audio.streaming:
+        return AudioWindowReader.from_waveform(torch.cat([audio.read(s, e) for s, e in frame_ranges]), audio.sample_rate)
+
+    with sf.SoundFile(dst_path, 'w', samplerate=audio.sample_rate, channels=1, subtype='FLOAT') as dst:
+        for start_frame, end_frame in frame_ranges:
+            dst.write(audio.read(start_frame, end_frame).numpy())
+    return AudioWindowReader(dst_path, streaming=True)
+
+
+class SpeechTimeline:
+    """Maps time in speech only audio, made by concatenating speech regions, back to time in the source media.
+    offset_sec is added on top, for audio that was cropped from the source.
+    """
+
+    def __init__(self, regions: np.ndarray, offset_sec: float = 0):
+        self.regions = regions
+        self.offset_sec = offset_sec
+        # start of every region within the speech only audio.
+        self.speech_starts = np.concatenate(([0], np.cumsum(regions[:, 1] - regions[:, 0])[:-1]))
+
+    def to_source(self, t: float, is_end: bool = False) -> float:
+        # end of one region and start of the next one are the same point in speech only audio.
+        side = 'left' if is_end else 'right'
+        idx = np.searchsorted(self.speech_starts, t, side=side) - 1
+        idx = min(max(idx, 0), len(self.regions) - 1)
+        return float(self.regions[idx, 0] + (t - self.speech_starts[idx]) + self.offset_sec)
+
+    def split(self, start: float, end: float) -> list[tuple[float, float]]:
+        """Splits a span of speech only audio at seams between regions, so every part maps to a single region
+        and removed non-speech in between doesn't end up inside the part's source time."""
+        seams = [float(t) for t in self.speech_starts[1:] if start < t < end]
+        bounds = [start] + seams + [end]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+
+def prefetch(items: Iterable, fn: Callable, max_prefetch: int = 2) -> Iterator:
+    """Yields (item, fn(item)) pairs in order of items, fn for upcoming items is computed in a background thread.
+    At most max_prefetch results are buffered, so memory stays bounded.
+    """
+    buffer = queue.Queue(maxsize=max_prefetch)
+    stop = threading.Event()
+    done = object()
+
+    def put(entry) -> bool:
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, fn(item))):
+                    return
+        except Exception as e:
+            put((done, e))
+            return
+        put((done, None))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, res = buffer.get()
+            if item is done:
+                if res is not None:
+                    raise res
+                return
+            yield item, res
+    finally:
+        # unblocks the producer if consumer stopped early
+        stop.set()
+
+
+class BackgroundConsumer:
+    """Consumes submitted items in order in a background thread, at most max_pending items wait in the queue.
+    Subclasses implement consume, finish runs once all items are consumed and teardown always runs last,
+    both in the background thread. The first error stops consuming and is raised on the next submit or on close,
+    the rest of the items are still drained, so submit never blocks on a dead consumer.
+    """
+
+    def __init__(self, max_pending: int = 64):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, item):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(item)
+
+    def close(self, raise_error: bool = True):
+        """Waits for submitted items to be consumed. Without raise_error, the consumer's error is kept in self.error,
+        so it doesn't replace an exception already propagating in the caller."""
+        self.queue.put(None)
+        self.thread.join()
+        if raise_error and self.error is not None:
+            raise self.error
+
+    def consume(self, item):
+        raise NotImplementedError
+
+    def finish(self):
+        pass
+
+    def teardown(self):
+        pass
+
+    def _run(self):
+        try:
+            while (item := self.queue.get()) is not None:
+                if self.error is not None:
+                    continue
+                try:
+                    self.consume(item)
+                except Exception as e:
+                    self.error = e
+            if self.error is None:
+                self.finish()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.teardown()
+
+
 def get_user_from_request(reqeust: gr.Request) -> str:
     if not reqeust:
         raise Exception(f"Access denied!")
@@ -173,3 +401,69 @@ def build_youtube_link_from_iframe(iframe: str):
     assert youtube_id
 
     return f"https://www.youtube.com/watch?v={youtube_id}"
+
+
+def plan_incremental_render(old_entries: list[dict] | None, new_entries: list[dict]) -> tuple[list[int], bool]:
+    """Decides which utterances of a combined render have to be rewritten.
+    Entries describe utterances in timeline order with 'hash', 'speaker_id' and 'frames'.
+    Returns indices to write and whether files have to be created from scratch.
+    Changed utterances of unchanged durations are patched in place, otherwise everything after the first change
+    is rewritten, as later utterances are shifted.
+    """
+    if not old_entries:
+        return list(range(len(new_entries))), True
+
+    def key(entry):
+        return entry['hash'], entry['speaker_id'], entry['frames']
+
+    num_common = min(len(old_entries), len(new_entries))
+    changed = [i for i in range(num_common) if key(old_entries[i]) != key(new_entries[i])]
+    same_frames = all(old_entries[i]['frames'] == new_entries[i]['frames'] for i in changed)
+    if len(old_entries) == len(new_entries) and same_frames:
+        return changed, False
+
+    first_changed = changed[0] if changed else num_common
+    if first_changed == 0:
+        return list(range(len(new_entries))), True
+    return list(range(first_changed, len(new_entries))), False
+
+
+def layout_timeline(starts: np.ndarray, lengths: np.ndarray, compress: bool = False,
+                    max_rate: float = 1.5) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Lays out segments sorted by start sample, each segment's slot lasts until the next segment starts.
+    With compress, segments longer than their slot are sped up to fit it, up to max_rate.
+    Returns compression rates, lengths after compression and overlaps with the next segment, all in samples.
+    """
+    next_starts = np.append(starts[1:], np.iinfo(np.int64).max)
+    slots = np.maximum(next_starts - starts, 1)
+    rates = np.ones(len(starts))
+    if compress:
+        rates = np.clip(lengths / slots, 1.0, max_rate)
+    placed_lengths = (lengths / rates).astype(np.int64)
+    overlaps = np.maximum(starts + placed_lengths - next_starts, 0)
+    return rates, placed_lengths, overlaps
+
+
+def time_compress(wav: np.ndarray, rate: float, frame_len: int = 1024) -> np.ndarray:
+    """Speeds audio up by rate keeping its pitch, with overlap-add of hann windowed frames at half frame hops.
+    Output has int(len(wav) / rate) samples, as layout_timeline expects.
+    """
+    out_len = int(len(wav) / rate)
+    if rate <= 1.0 or len(wav) < frame_len:
+        return wav[:out_len]
+
+    hop = frame_len // 2
+    num_frames = -(-out_len // hop)
+    analysis_starts = np.minimum(np.round(np.arange(num_frames) * hop * rate).astype(np.int64), len(wav) - frame_len)
+    window = np.hanning(frame_len + 1)[:-1].astype(np.float32)
+    frames = wav[analysis_starts[:, None] + np.arange(frame_len)] * window
+
+    # at half frame hops, every output block is the sum of the second half of one frame and the first of the next.
+    out = np.zeros((num_frames + 1, hop), dtype=np.float32)
+    out[:-1] += frames[:, :hop]
+    out[1:] += frames[:, hop:]
+    norm = np.zeros((num_frames + 1, hop), dtype=np.float32)
+    norm[:-1] += window[:hop]
+    norm[1:] += window[hop:]
+    out = out.ravel() / np.maximum(norm.ravel(), 1e-3)
+    return out[:out_len]